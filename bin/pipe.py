@@ -1,9 +1,13 @@
 import base64
 import json
+import multiprocessing
+import os
 import sys
+import threading
 import traceback
 import six
-from six.moves import input
+from six.moves import input, queue
+from time import perf_counter
 
 with open('algorithmia.conf') as config_file:
     config = json.load(config_file)
@@ -15,6 +19,12 @@ algorithm = __import__('src.'+config['algoname'], fromlist=["apply"])
 
 FIFO_PATH = '/tmp/algoout'
 
+# Server mode is enabled by setting PIPE_SERVER_MODE, see `serve` for details.
+SERVER_MODE = os.environ.get('PIPE_SERVER_MODE', '') not in ['', '0']
+SERVER_WORKERS = int(os.environ.get('PIPE_SERVER_WORKERS', '2'))
+BATCH_WINDOW = float(os.environ.get('PIPE_BATCH_WINDOW', '0.01'))
+MAX_BATCH_SIZE = int(os.environ.get('PIPE_MAX_BATCH_SIZE', '64'))
+
 def main():
     print('PIPE_INIT_COMPLETE')
     sys.stdout.flush()
@@ -41,41 +51,59 @@ def is_binary(arg):
     return isinstance(arg, bytearray)
 
 def get_response(request):
+    return dump_response(build_response(request))
+
+def dump_response(response):
+    try:
+        return json.dumps(response)
+    except Exception as e:
+        error = format_error(e, traceback.format_exc())
+        if 'request_id' in response:
+            error['request_id'] = response['request_id']
+        return json.dumps(error)
+
+def build_response(request):
     try:
         result = call_algorithm(request)
-        if is_binary(result):
-            content_type = 'binary'
-            result = base64.b64encode(result)
-
-            # In python 3, the encoded result is a byte array which cannot be
-            # json serialized so we need to turn this into a string.
-            if not isinstance(result, six.string_types):
-                result = str(result, 'utf-8')
-        elif isinstance(result, six.string_types) or isinstance(result, six.text_type):
-            content_type = 'text'
-        else:
-            content_type = 'json'
-
-        response_string = json.dumps({
-            'result': result,
-            'metadata': {
-                'content_type': content_type
-            }
-        })
+        response = format_result(result)
     except Exception as e:
-        if hasattr(e, 'error_type'):
-            error_type = e.error_type
-        else:
-            error_type = 'AlgorithmError'
-        response_string = json.dumps({
-            'error': {
-                'message': str(e),
-                'stacktrace': traceback.format_exc(),
-                'error_type': error_type
-            }
-        })
+        response = format_error(e, traceback.format_exc())
 
-    return response_string
+    return response
+
+def format_result(result):
+    if is_binary(result):
+        content_type = 'binary'
+        result = base64.b64encode(result)
+
+        # In python 3, the encoded result is a byte array which cannot be
+        # json serialized so we need to turn this into a string.
+        if not isinstance(result, six.string_types):
+            result = str(result, 'utf-8')
+    elif isinstance(result, six.string_types) or isinstance(result, six.text_type):
+        content_type = 'text'
+    else:
+        content_type = 'json'
+
+    return {
+        'result': result,
+        'metadata': {
+            'content_type': content_type
+        }
+    }
+
+def format_error(e, stacktrace):
+    if hasattr(e, 'error_type'):
+        error_type = e.error_type
+    else:
+        error_type = 'AlgorithmError'
+    return {
+        'error': {
+            'message': str(e),
+            'stacktrace': stacktrace,
+            'error_type': error_type
+        }
+    }
 
 def wrap_binary_data(data):
     if six.PY3:
@@ -83,14 +111,157 @@ def wrap_binary_data(data):
     return bytearray(data)
 
 def call_algorithm(request):
+    return algorithm.apply(request_data(request))
+
+def request_data(request):
     if request['content_type'] in ['text', 'json']:
         data = request['data']
     elif request['content_type'] == 'binary':
         data = wrap_binary_data(base64.b64decode(request['data']))
     else:
         raise Exception("Invalid content_type: {}".format(request['content_type']))
+    return data
+
+def serve():
+    r"""
+    Serves requests concurrently, rather than one at a time.
+
+    - Requests the algorithm can batch (those for which `algorithm.batch_key` returns a key) are served in this process.
+    Requests that arrive within PIPE_BATCH_WINDOW seconds of each other and share a batch key are
+    passed together to `algorithm.apply_batch`, up to PIPE_MAX_BATCH_SIZE at a time.
+    - Every other request, like training, is run in a separate process, at most PIPE_SERVER_WORKERS at a time,
+    so it never holds up the batched requests. Each request gets a fresh, non-daemonic process, as training
+    can start processes of its own.
+
+    Responses are written back as soon as they're ready, so not necessarily in the order the requests arrived.
+    Every response is tagged with the `request_id` of its request, or the request's position in the input stream if it has none.
+    """
+    print('PIPE_INIT_COMPLETE')
+    sys.stdout.flush()
 
-    return algorithm.apply(data)
+    write_lock = threading.Lock()
+    batch_queue = queue.Queue()
+    worker_slots = threading.BoundedSemaphore(SERVER_WORKERS)
+    workers = []
+    batcher = threading.Thread(target=serve_batches, args=(batch_queue, write_lock))
+    batcher.start()
+
+    request_count = 0
+    while True:
+        try:
+            line = input()
+        except EOFError:
+            break
+
+        request = json.loads(line)
+        request_id = request.get('request_id', request_count)
+        request_count += 1
+        if get_batch_key(request) is None:
+            worker = threading.Thread(target=serve_request, args=(request, request_id, write_lock, worker_slots))
+            worker.start()
+            workers.append(worker)
+        else:
+            batch_queue.put((request_id, request))
+
+    batch_queue.put(None)
+    batcher.join()
+    for worker in workers:
+        worker.join()
+
+# Waits for a free worker slot, then serves the request in its own process.
+def serve_request(request, request_id, write_lock, worker_slots):
+    with worker_slots:
+        response = build_process_response(request)
+    write_response(response, request_id, write_lock)
+
+def build_process_response(request):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=send_response, args=(request, sender))
+    process.start()
+    sender.close()
+    try:
+        response = receiver.recv()
+    except EOFError:
+        response = None
+    process.join()
+    if response is None:
+        error = Exception('the worker process exited with code {}'.format(str(process.exitcode)))
+        response = format_error(error, repr(error))
+    return response
+
+def send_response(request, sender):
+    sender.send(build_response(request))
+    sender.close()
+
+def get_batch_key(request):
+    if not hasattr(algorithm, 'apply_batch') or not hasattr(algorithm, 'batch_key'):
+        return None
+    try:
+        return algorithm.batch_key(request_data(request))
+    except Exception:
+        return None
+
+def serve_batches(batch_queue, write_lock):
+    stopping = False
+    while not stopping:
+        item = batch_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = perf_counter() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = batch_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+
+        groups = dict()
+        for request_id, request in batch:
+            groups.setdefault(get_batch_key(request), []).append((request_id, request))
+        for group in groups.values():
+            request_ids = [request_id for request_id, _ in group]
+            responses = build_batch_responses([request for _, request in group])
+            for request_id, response in zip(request_ids, responses):
+                write_response(response, request_id, write_lock)
+
+def build_batch_responses(requests):
+    try:
+        results = algorithm.apply_batch([request_data(request) for request in requests])
+    except Exception:
+        return [build_response(request) for request in requests]
+    responses = []
+    for result in results:
+        if isinstance(result, Exception):
+            stacktrace = ''.join(traceback.format_exception(type(result), result, result.__traceback__))
+            responses.append(format_error(result, stacktrace))
+        else:
+            try:
+                responses.append(format_result(result))
+            except Exception as e:
+                responses.append(format_error(e, traceback.format_exc()))
+    return responses
+
+def write_response(response, request_id, write_lock):
+    response['request_id'] = request_id
+    response_string = dump_response(response)
+    with write_lock:
+        # Flush stdout before writing back response
+        sys.stdout.flush()
+
+        with open(FIFO_PATH, 'w') as f:
+            f.write(response_string)
+            f.write('\n')
 
 if __name__ == '__main__':
-    main()
+    if SERVER_MODE:
+        serve()
+    else:
+        main()
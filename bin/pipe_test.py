@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+import threading
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pipe
+
+
+# Serves a single request the way server mode does, and returns the response written back for it.
+def serve(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(pipe, 'FIFO_PATH', str(tmp_path / 'algoout'))
+    pipe.serve_request(request, 0, threading.Lock(), threading.BoundedSemaphore(1))
+    with open(pipe.FIFO_PATH) as f:
+        return json.loads(f.read())
+
+
+def train_request(tmp_path, **parameters):
+    data_path = tmp_path / 'data.json'
+    with open(str(data_path), 'w') as f:
+        json.dump({'tensor': np.random.rand(60, 2).tolist()}, f)
+    data = {'mode': 'train',
+            'data_path': 'file:/' + str(data_path),
+            'model_output_path': 'file:/' + str(tmp_path / 'model.zip'),
+            'training_time': 2,
+            'forecast_length': 4}
+    data.update(parameters)
+    return {'content_type': 'json', 'data': data}
+
+
+def test_server_distributed_training(tmp_path, monkeypatch):
+    response = serve(train_request(tmp_path, workers=2), tmp_path, monkeypatch)
+
+    assert 'error' not in response, response['error']['message']
+    assert response['request_id'] == 0
+    assert os.path.isfile(response['result']['model_output_path'])
+
+
+def test_server_sweep(tmp_path, monkeypatch):
+    response = serve(train_request(tmp_path, model_complexity=[0.1, 0.5]), tmp_path, monkeypatch)
+
+    assert 'error' not in response, response['error']['message']
+    assert len(response['result']['leaderboard']) == 2
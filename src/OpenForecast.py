@@ -1,5 +1,12 @@
+import os
+from uuid import uuid4
+import numpy as np
 from src.modules import data_utilities, network_utilities
-from src.modules import model_manager
+from src.modules import model_manager, model_cache, distributed_training, model_sweep, profiling
+
+# The environment variable setting the number of inter-op threads of the worker process.
+INTER_OP_THREADS_VARIABLE = 'OPENFORECAST_INTER_OP_THREADS'
+model_manager.configure_inter_op_threads(int(os.environ.get(INTER_OP_THREADS_VARIABLE, '0')) or None)
 
 
 class Parameters:
@@ -14,6 +21,28 @@ class Parameters:
         self.model_complexity = 0.5
         self.io_noise = 0.05
         self.outlier_removal_multiplier = 4
+        self.window_length = None
+        self.burn_in = 10
+        self.batch_size = 32
+        self.truncation_length = None
+        self.checkpoint_rollouts = False
+        self.validation_fraction = None
+        self.patience = None
+        self.workers = 1
+        self.sweep_candidates = None
+        self.save_state = False
+        self.incremental = False
+        self.state_input_path = None
+        self.state_output_path = None
+        self.quantize = False
+        self.num_samples = 1
+        self.quantiles = None
+        self.seed = None
+        self.forecast_threads = 1
+        self.intra_op_threads = None
+        self.profile = False
+        self.torch_profile_steps = None
+        self.torch_trace_path = None
 
 
 
@@ -22,9 +51,26 @@ def process_input(input):
 
     if 'outlier_removal_multiplier' in input:
         parameters.outlier_removal_multiplier = type_check(input, 'outlier_removal_multiplier', [int, float])
+    if 'profile' in input:
+        parameters.profile = type_check(input, 'profile', bool)
+    if 'torch_profile_steps' in input:
+        parameters.torch_profile_steps = type_check(input, 'torch_profile_steps', int)
+        if parameters.torch_profile_steps < 1:
+            raise network_utilities.AlgorithmError("'torch_profile_steps' must be at least 1")
+        if not profiling.TORCH_PROFILES_SUPPORTED:
+            raise network_utilities.AlgorithmError("'torch_profile_steps' requires torch 1.8.1 or newer")
+    if 'torch_trace_path' in input:
+        parameters.torch_trace_path = type_check(input, 'torch_trace_path', str)
+    if 'intra_op_threads' in input:
+        parameters.intra_op_threads = type_check(input, 'intra_op_threads', int)
+        if parameters.intra_op_threads < 1:
+            raise network_utilities.AlgorithmError("'intra_op_threads' must be at least 1")
+    if 'inter_op_threads' in input:
+        raise network_utilities.AlgorithmError("'inter_op_threads' is set for the whole worker process, "
+                                               "with the {} environment variable".format(INTER_OP_THREADS_VARIABLE))
 
     if 'data_path' in input:
-        parameters.data_path = type_check(input, 'data_path', str)
+        parameters.data_path = type_check(input, 'data_path', [str, list])
     else:
         raise network_utilities.AlgorithmError("'data_path' required")
 
@@ -34,14 +80,51 @@ def process_input(input):
         else:
             raise network_utilities.AlgorithmError("mode is invalid, must be 'forecast', or 'train'")
     if parameters.mode == "train":
+        if isinstance(parameters.data_path, list):
+            raise network_utilities.AlgorithmError("'data_path' must be a single path for training")
         if 'model_input_path' in input:
             parameters.model_input_path = type_check(input, 'model_input_path', str)
         if 'model_complexity' in input:
-            parameters.model_complexity = type_check(input, 'model_complexity', [int, float])
+            parameters.model_complexity = type_check(input, 'model_complexity', [int, float, list])
+        if 'io_noise' in input:
+            parameters.io_noise = type_check(input, 'io_noise', [int, float, list])
         if 'training_time' in input:
                 parameters.training_time = type_check(input, 'training_time', [int, float])
         if 'forecast_length' in input:
             parameters.forecast_length = type_check(input, 'forecast_length', int)
+        if 'window_length' in input:
+            parameters.window_length = type_check(input, 'window_length', int)
+            if parameters.window_length < 1:
+                raise network_utilities.AlgorithmError("'window_length' must be at least 1")
+        if 'burn_in' in input:
+            parameters.burn_in = type_check(input, 'burn_in', int)
+            if parameters.burn_in < 0:
+                raise network_utilities.AlgorithmError("'burn_in' can't be negative")
+        if 'batch_size' in input:
+            parameters.batch_size = type_check(input, 'batch_size', int)
+            if parameters.batch_size < 1:
+                raise network_utilities.AlgorithmError("'batch_size' must be at least 1")
+        if 'truncation_length' in input:
+            parameters.truncation_length = type_check(input, 'truncation_length', int)
+            if parameters.truncation_length < 1:
+                raise network_utilities.AlgorithmError("'truncation_length' must be at least 1")
+        if 'checkpoint_rollouts' in input:
+            parameters.checkpoint_rollouts = type_check(input, 'checkpoint_rollouts', bool)
+        if 'validation_fraction' in input:
+            parameters.validation_fraction = type_check(input, 'validation_fraction', [int, float])
+            if not 0 <= parameters.validation_fraction < 1:
+                raise network_utilities.AlgorithmError("'validation_fraction' must be between 0 and 1")
+        if 'patience' in input:
+            parameters.patience = type_check(input, 'patience', int)
+            if parameters.patience < 1:
+                raise network_utilities.AlgorithmError("'patience' must be at least 1")
+        if 'workers' in input:
+            parameters.workers = type_check(input, 'workers', int)
+            if parameters.workers < 1:
+                raise network_utilities.AlgorithmError("'workers' must be at least 1")
+        if 'save_state' in input:
+            parameters.save_state = type_check(input, 'save_state', bool)
+        process_sweep_candidates(parameters)
         if 'model_output_path' in input:
             parameters.model_output_path = type_check(input, 'model_output_path', str)
         else:
@@ -51,6 +134,37 @@ def process_input(input):
             parameters.forecast_length = type_check(input, 'forecast_length', int)
         if 'graph_save_path' in input:
             parameters.graph_save_path = type_check(input, 'graph_save_path', str)
+            if isinstance(parameters.data_path, list):
+                raise network_utilities.AlgorithmError("'graph_save_path' can't be used with a list of 'data_path's")
+        if isinstance(parameters.data_path, list):
+            for path in parameters.data_path:
+                if not isinstance(path, str):
+                    raise network_utilities.AlgorithmError("'data_path' must be of {} or a list of them".format(str(str)))
+        if 'incremental' in input:
+            parameters.incremental = type_check(input, 'incremental', bool)
+        if 'state_input_path' in input:
+            parameters.state_input_path = type_check(input, 'state_input_path', str)
+        if 'state_output_path' in input:
+            parameters.state_output_path = type_check(input, 'state_output_path', str)
+        if 'quantize' in input:
+            parameters.quantize = type_check(input, 'quantize', bool)
+            if parameters.quantize and not model_manager.QUANTIZATION_SUPPORTED:
+                raise network_utilities.AlgorithmError("'quantize' requires torch 1.3 or newer")
+        if 'num_samples' in input:
+            parameters.num_samples = type_check(input, 'num_samples', int)
+            if parameters.num_samples < 1:
+                raise network_utilities.AlgorithmError("'num_samples' must be at least 1")
+        if 'quantiles' in input:
+            parameters.quantiles = type_check(input, 'quantiles', list)
+            for quantile in parameters.quantiles:
+                if not isinstance(quantile, (int, float)) or isinstance(quantile, bool) or not 0 <= quantile <= 1:
+                    raise network_utilities.AlgorithmError("'quantiles' must be a list of numbers between 0 and 1")
+        if 'seed' in input:
+            parameters.seed = type_check(input, 'seed', int)
+        if 'forecast_threads' in input:
+            parameters.forecast_threads = type_check(input, 'forecast_threads', int)
+        if (parameters.state_input_path or parameters.state_output_path) and not parameters.incremental:
+            raise network_utilities.AlgorithmError("'state_input_path' and 'state_output_path' require 'incremental' forecasting")
         if 'model_input_path' in input:
             parameters.model_input_path = type_check(input, 'model_input_path', str)
         else:
@@ -60,6 +174,29 @@ def process_input(input):
 
 
 
+# If `model_complexity` or `io_noise` is a list, every combination of them is a candidate model in a sweep,
+# the first candidate's values are used to process the input data.
+def process_sweep_candidates(parameters):
+    complexities = parameters.model_complexity
+    noises = parameters.io_noise
+    if not isinstance(complexities, list) and not isinstance(noises, list):
+        return parameters
+    complexities = complexities if isinstance(complexities, list) else [complexities]
+    noises = noises if isinstance(noises, list) else [noises]
+    for value in complexities + noises:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise network_utilities.AlgorithmError("'model_complexity' and 'io_noise' must be numbers, or lists of numbers")
+    if not complexities or not noises:
+        raise network_utilities.AlgorithmError("'model_complexity' and 'io_noise' lists can't be empty")
+    if parameters.model_input_path:
+        raise network_utilities.AlgorithmError("a sweep can't be used to retrain an existing model")
+    if parameters.workers > 1:
+        raise network_utilities.AlgorithmError("'workers' can't be used in a sweep, candidates are already trained in parallel")
+    parameters.sweep_candidates = [(complexity, noise) for complexity in complexities for noise in noises]
+    parameters.model_complexity, parameters.io_noise = parameters.sweep_candidates[0]
+    return parameters
+
+
 def type_check(dic, id, typedef):
     if isinstance(typedef, type):
         if isinstance(dic[id], typedef):
@@ -74,45 +211,257 @@ def type_check(dic, id, typedef):
 
 
 def forecast(input: Parameters):
+    output = forecast_batch([input])[0]
+    if isinstance(output, Exception):
+        raise output
+    return output
+
+
+def forecast_batch(inputs: list):
+    r"""
+    Serves a list of forecast requests in as few passes through the network as possible.
+    Every series of every request against the same model, with the same forecast length and data shape, is stacked along
+    the batch dimension and forecast together.
+    Returns a list with the output of every request, or the exception raised while serving it.
+    """
+
+    outputs = [None] * len(inputs)
+    requests = [None] * len(inputs)
+    groups = dict()
+    for i, input in enumerate(inputs):
+        try:
+            with profiling.phase('model_load'):
+                network, meta_data = model_cache.get_model_package(input.model_input_path, input.quantize)
+            series, meta_data, is_batch = load_series(input, meta_data)
+            state = load_state(input, meta_data, is_batch)
+        except Exception as e:
+            outputs[i] = e
+            continue
+        requests[i] = {'series': series, 'forecasts': [None] * len(series), 'meta_data': meta_data,
+                       'is_batch': is_batch, 'state': state}
+        for j, data in enumerate(series):
+            key = (input.model_input_path, input.quantize, meta_data['forecast_length'], data.shape,
+                   input.num_samples, input.seed, input.forecast_threads)
+            groups.setdefault(key, []).append((i, j, network, meta_data))
+    profiling.record('model_cache', model_cache.cache.stats())
+
+    for key, group in groups.items():
+        _, _, network, meta_data = group[0]
+        _, _, _, _, num_samples, seed, threads = key
+        try:
+            model = model_manager.Model(meta_data, network, buffers=model_cache.get_inference_buffers(network))
+            if seed is not None:
+                model.seed_noise(seed)
+            batch = np.stack([requests[i]['series'][j] for i, j, _, _ in group], axis=1)
+            states = [requests[i]['state'] for i, _, _, _ in group]
+            with profiling.torch_profile('forecast'):
+                forecast_results, residual, memory = model.forecast_with_state(batch, states, num_samples, threads)
+        except Exception as e:
+            for i, _, _, _ in group:
+                outputs[i] = e
+            continue
+        for b, (i, j, _, _) in enumerate(group):
+            requests[i]['forecasts'][j] = forecast_results[b]
+            if requests[i]['state']:
+                requests[i]['final_state'] = (residual[:, b:b + 1], memory[:, b:b + 1])
+
+    for i, input in enumerate(inputs):
+        if outputs[i] is not None:
+            continue
+        try:
+            outputs[i] = format_forecast_output(input, requests[i])
+        except Exception as e:
+            outputs[i] = e
+    return outputs
+
+
+# A forecast request can contain many series, either as a list of `data_path`s, or as a dataset with a 3d tensor of shape
+# [sequence, series, io_dimension]. Returns every series as its own [sequence, io_dimension] array,
+# and whether the request contained a batch of series.
+def load_series(input: Parameters, meta_data: dict):
+    data_paths = input.data_path if isinstance(input.data_path, list) else [input.data_path]
+    is_batch = isinstance(input.data_path, list)
+    series = []
+    for data_path in data_paths:
+        data = network_utilities.load_dataset(data_path)
+        with profiling.phase('process_input'):
+            data, meta_data = data_utilities.process_input(data, input, meta_data)
+        if len(data.shape) == 3:
+            is_batch = True
+            series.extend(data[:, i] for i in range(data.shape[1]))
+        else:
+            series.append(data)
+    return series, meta_data, is_batch
+
+
+# Incremental forecasts continue from a saved recurrent state, either the one saved with the model package at the end
+# of its training data, or a state saved by a previous incremental forecast at `state_input_path`.
+def load_state(input: Parameters, meta_data: dict, is_batch: bool):
+    if not input.incremental:
+        return None
+    if is_batch:
+        raise network_utilities.AlgorithmError("incremental forecasts only support a single series")
+    if input.state_input_path:
+        state = network_utilities.get_state(input.state_input_path)
+    else:
+        state = network_utilities.get_package_state(input.model_input_path)
+        if state is None:
+            raise network_utilities.AlgorithmError("the model at 'model_input_path' has no saved state, "
+                                                   "train it with 'save_state' to forecast incrementally")
+    state = model_manager.import_state(state)
+    for name in ['residual', 'memory']:
+        if list(state[name].shape) != list(meta_data['tensor_shape'][name]):
+            raise network_utilities.AlgorithmError("the saved state doesn't match the model at 'model_input_path'")
+    return state
+
+
+def format_forecast_output(input: Parameters, request: dict):
     output = dict()
-    network, meta_data = network_utilities.get_model_package(input.model_input_path)
-    data_path = network_utilities.get_data(input.data_path)
-    data = network_utilities.load_json(data_path)
-    data, meta_data = data_utilities.process_input(data, input, meta_data)
-    model = model_manager.Model(meta_data, network)
-    forecast_result = model.forecast(data)
-    output['forecast'] = data_utilities.format_forecast(forecast_result, meta_data)
+    meta_data = request['meta_data']
+    if 'quantization' in meta_data:
+        output['quantization'] = meta_data['quantization']
+    if request['is_batch']:
+        if input.graph_save_path:
+            raise network_utilities.AlgorithmError("'graph_save_path' can't be used when forecasting many series")
+        with profiling.phase('format_forecast'):
+            output['forecast'] = [data_utilities.format_forecast(forecast_result, meta_data, input.quantiles)
+                                  for forecast_result in request['forecasts']]
+        return output
+    data = request['series'][0]
+    forecast_result = request['forecasts'][0]
+    with profiling.phase('format_forecast'):
+        output['forecast'] = data_utilities.format_forecast(forecast_result, meta_data, input.quantiles)
     if input.graph_save_path:
-        local_graph_path = data_utilities.generate_graph(data, forecast_result, meta_data)
+        if input.num_samples > 1:
+            forecast_result = forecast_result.mean(axis=0)
+        with profiling.phase('graph'):
+            local_graph_path = data_utilities.generate_graph(data, forecast_result, meta_data)
         output['graph_save_path'] = network_utilities.put_file(local_graph_path, input.graph_save_path)
+    if request['state']:
+        residual, memory = request['final_state']
+        last_index = request['state']['last_index'] + data.shape[0]
+        output['last_index'] = last_index
+        if input.state_output_path:
+            state = model_manager.export_state(residual, memory, last_index)
+            output['state_output_path'] = network_utilities.put_state(state, input.state_output_path)
 
     return output
 
 
 def train(input):
     output = dict()
-    data_path = network_utilities.get_data(input.data_path)
-    local_data = network_utilities.load_json(data_path)
+    local_data = network_utilities.load_dataset(input.data_path)
     if input.model_input_path:
-        _, meta_data = network_utilities.get_model_package(input.model_input_path)
-        data, meta_data = data_utilities.process_input(local_data, input, meta_data)
+        with profiling.phase('model_load'):
+            weights, meta_data = network_utilities.get_package_weights(input.model_input_path)
+            optimizer_state = network_utilities.get_package_optimizer_state(input.model_input_path)
+        with profiling.phase('process_input'):
+            data, meta_data = data_utilities.process_input(local_data, input, meta_data)
+        network = model_manager.restore_network(weights, meta_data['architecture'])
+        model = model_manager.Model(meta_data, network, optimizer_state)
     else:
-        data, meta_data = data_utilities.process_input(local_data, input)
-    model = model_manager.Model(meta_data)
-    error = model.train_model(data)
-    forecast_result = model.forecast(data)
+        with profiling.phase('process_input'):
+            data, meta_data = data_utilities.process_input(local_data, input)
+        model = model_manager.Model(meta_data)
+    with profiling.phase('train_model'):
+        if input.sweep_candidates:
+            model, meta_data, error, leaderboard = model_sweep.sweep(meta_data, data, input.sweep_candidates,
+                                                                     input.training_time)
+            output['leaderboard'] = leaderboard
+        elif input.workers > 1:
+            error = distributed_training.train_model(model, meta_data, data, input.workers)
+        else:
+            error = model.train_model(data)
+    with profiling.torch_profile('forecast'):
+        forecast_result, residual, memory = model.forecast_with_state(data)
     network = model.extract_network()
-    output['forecast'] = data_utilities.format_forecast(forecast_result, meta_data)
-    output['model_output_path'] = network_utilities.save_model_package(network, meta_data, input.model_output_path)
+    if input.save_state:
+        state = model_manager.export_state(residual, memory, data.shape[0] - 1)
+    else:
+        state = None
+    with profiling.phase('format_forecast'):
+        output['forecast'] = data_utilities.format_forecast(forecast_result, meta_data)
+    optimizer_state = model.extract_optimizer_state()
+    with profiling.phase('save_model_package'):
+        output['model_output_path'] = network_utilities.save_model_package(network, meta_data,
+                                                                           input.model_output_path,
+                                                                           state, optimizer_state)
     output['final_error'] = float(error)
     return output
 
 def apply(input):
     guard = process_input(input)
-    if guard.mode == "forecast":
-        output = forecast(guard)
-    else:
-        output = train(guard)
+    with model_manager.intra_op_threads(guard.intra_op_threads):
+        with profiling.profile(guard.profile, guard.torch_profile_steps) as profiler:
+            if guard.mode == "forecast":
+                output = forecast(guard)
+            else:
+                output = train(guard)
+    if profiler:
+        add_profiles(guard, output, profiler)
 
     return output
 
+
+# Adds the `timings` and torch profiles a request asked for to its output, torch profiles are only summarized
+# in the output, their Chrome traces are only written when the request asks for them to be saved under `torch_trace_path`.
+def add_profiles(input: Parameters, output: dict, profiler):
+    if input.profile:
+        output['timings'] = profiler.report()
+        profiling.log_report(output['timings'])
+    if input.torch_profile_steps:
+        output['torch_profile'] = dict()
+        for name, summary in profiler.torch_profiles.items():
+            output['torch_profile'][name] = {'operators': summary['operators'], 'table': summary['table']}
+            if input.torch_trace_path:
+                trace_path = '{}/{}_trace.json'.format(input.torch_trace_path.rstrip('/'), name)
+                local_path = '/tmp/{}.json'.format(str(uuid4()))
+                try:
+                    summary['profile'].export_trace(local_path)
+                    output['torch_profile'][name]['trace_path'] = network_utilities.put_file(local_path, trace_path)
+                finally:
+                    if os.path.exists(local_path):
+                        os.remove(local_path)
+
+
+# Requests with the same batch key can be served together by `apply_batch`, requests that can't be batched return None.
+def batch_key(input):
+    if isinstance(input, dict) and input.get('mode') == "forecast" and isinstance(input.get('model_input_path'), str):
+        return input['model_input_path']
+    return None
+
+
+# Like `apply`, but for a list of requests, forecast requests are batched together by `forecast_batch`.
+# Returns a list with the output of every request, or the exception raised while serving it.
+def apply_batch(inputs: list):
+    outputs = [None] * len(inputs)
+    forecast_requests = []
+    for i, input in enumerate(inputs):
+        try:
+            guard = process_input(input)
+            if guard.mode == "forecast":
+                forecast_requests.append((i, guard))
+            else:
+                with model_manager.intra_op_threads(guard.intra_op_threads):
+                    with profiling.profile(guard.profile, guard.torch_profile_steps) as profiler:
+                        outputs[i] = train(guard)
+                if profiler:
+                    add_profiles(guard, outputs[i], profiler)
+        except Exception as e:
+            outputs[i] = e
+    # The forecasts are served together, so requests that asked for profiles get those of the whole batch,
+    # and the batch uses the fewest intra-op threads any of them asked for.
+    timings = any(guard.profile for _, guard in forecast_requests)
+    torch_profile_steps = max([guard.torch_profile_steps or 0 for _, guard in forecast_requests] + [0])
+    threads = [guard.intra_op_threads for _, guard in forecast_requests if guard.intra_op_threads]
+    with model_manager.intra_op_threads(min(threads) if threads else None):
+        with profiling.profile(timings, torch_profile_steps) as profiler:
+            forecast_outputs = forecast_batch([guard for _, guard in forecast_requests])
+    for (i, guard), output in zip(forecast_requests, forecast_outputs):
+        if profiler and isinstance(output, dict):
+            try:
+                add_profiles(guard, output, profiler)
+            except Exception as e:
+                output = e
+        outputs[i] = output
+    return outputs
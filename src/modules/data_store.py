@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from time import sleep
+from uuid import uuid4
+from requests.exceptions import ConnectionError
+
+
+class AlgorithmiaStore:
+    r"""
+    The remote store backed by the Algorithmia data API, which is where `data://` style paths live.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    # Returns the size and last modified time of a remote file, or None if the data API doesn't tell us.
+    def stat(self, remote_path: str):
+        try:
+            response = self.client.headHelper(self.client.file(remote_path).url)
+        except ConnectionError:
+            sleep(5)
+            return self.stat(remote_path)
+        if response.status_code != 200:
+            return None
+        size = response.headers.get('Content-Length')
+        last_modified = response.headers.get('Last-Modified')
+        if size is None or last_modified is None:
+            return None
+        return int(size), last_modified
+
+    def exists(self, remote_path: str):
+        try:
+            return self.client.file(remote_path).exists()
+        except ConnectionError:
+            sleep(5)
+            return self.exists(remote_path)
+
+    def fetch(self, remote_path: str, local_path: str):
+        try:
+            temp_file = self.client.file(remote_path).getFile()
+        except ConnectionError:
+            sleep(5)
+            return self.fetch(remote_path, local_path)
+        temp_file.close()
+        shutil.move(temp_file.name, local_path)
+        return local_path
+
+    def put(self, local_path: str, remote_path: str):
+        try:
+            self.client.file(remote_path).putFile(local_path)
+        except ConnectionError:
+            sleep(5)
+            return self.put(local_path, remote_path)
+        return remote_path
+
+
+class LocalStore:
+    r"""
+    A local directory standing in for a remote store, a path like `data://collection/file.json` maps to
+    `<root>/collection/file.json`. Useful for working and testing offline.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def local_path(self, remote_path: str):
+        return os.path.join(self.root, re.sub(r'^[a-zA-Z0-9]+://', '', remote_path))
+
+    def stat(self, remote_path: str):
+        path = self.local_path(remote_path)
+        if not os.path.isfile(path):
+            return None
+        file_stat = os.stat(path)
+        return file_stat.st_size, file_stat.st_mtime
+
+    def exists(self, remote_path: str):
+        return os.path.isfile(self.local_path(remote_path))
+
+    def fetch(self, remote_path: str, local_path: str):
+        shutil.copyfile(self.local_path(remote_path), local_path)
+        return local_path
+
+    def put(self, local_path: str, remote_path: str):
+        path = self.local_path(remote_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path)
+        return remote_path
+
+
+class FileCache:
+    r"""
+    A content addressed, on-disk cache for files fetched from a remote store.
+
+    Files are stored once per unique content digest under `<directory>/objects`, and an index maps remote paths to
+    the digest along with the size and last modified time the remote store reported when it was fetched.
+    If the remote store still reports the same size and last modified time, the cached file is used, otherwise it's fetched again.
+
+    When the cached files take up more than `max_bytes`, the least recently used are evicted.
+    Cached files are shared between callers and must be treated as read only.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_directory = os.path.join(directory, 'objects')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, store, remote_path: str):
+        os.makedirs(self.objects_directory, exist_ok=True)
+        index = self.load_index()
+        remote_stat = store.stat(remote_path)
+        entry = index.get(remote_path)
+        if entry and remote_stat and [entry['size'], entry['last_modified']] == list(remote_stat):
+            object_path = self.object_path(entry['digest'])
+            if os.path.isfile(object_path):
+                self.hits += 1
+                os.utime(object_path)
+                return object_path
+        self.misses += 1
+        temp_path = os.path.join(self.directory, 'fetch-{}'.format(str(uuid4())))
+        store.fetch(remote_path, temp_path)
+        digest = file_fingerprint(temp_path)
+        object_path = self.object_path(digest)
+        os.replace(temp_path, object_path)
+        if remote_stat:
+            index = self.load_index()
+            index[remote_path] = {'digest': digest, 'size': remote_stat[0], 'last_modified': remote_stat[1]}
+            self.save_index(index)
+        self.evict(keep=object_path)
+        return object_path
+
+    def object_path(self, digest: str):
+        return os.path.join(self.objects_directory, digest)
+
+    def evict(self, keep: str = None):
+        objects = []
+        for name in os.listdir(self.objects_directory):
+            path = self.object_path(name)
+            file_stat = os.stat(path)
+            objects.append((file_stat.st_mtime, file_stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in objects)
+        evicted = set()
+        for _, size, path in sorted(objects):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            evicted.add(os.path.basename(path))
+            total_bytes -= size
+        if evicted:
+            index = self.load_index()
+            index = {path: entry for path, entry in index.items() if entry['digest'] not in evicted}
+            self.save_index(index)
+
+    def load_index(self):
+        if not os.path.isfile(self.index_path):
+            return dict()
+        with open(self.index_path, 'r') as f:
+            return json.load(f)
+
+    # Written to a temporary file first, so concurrent readers never see a partially written index.
+    def save_index(self, index: dict):
+        temp_path = '{}.{}'.format(self.index_path, str(uuid4()))
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# A digest of the file's contents, used to tell apart different versions of a file stored at the same path.
+def file_fingerprint(file_path: str):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
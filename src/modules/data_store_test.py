@@ -0,0 +1,49 @@
+import os
+from src.modules.data_store import FileCache, LocalStore
+
+
+def write_remote_file(store, remote_path, content):
+    path = store.local_path(remote_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_cache_hit(tmp_path):
+    store = LocalStore(str(tmp_path / 'remote'))
+    cache = FileCache(str(tmp_path / 'cache'), 1024)
+    write_remote_file(store, "data://TimeSeries/test.json", '{"tensor": [[1.0]]}')
+    first_path = cache.get(store, "data://TimeSeries/test.json")
+    second_path = cache.get(store, "data://TimeSeries/test.json")
+
+    assert first_path == second_path
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+    with open(second_path) as f:
+        assert f.read() == '{"tensor": [[1.0]]}'
+
+
+def test_cache_refetches_changed_file(tmp_path):
+    store = LocalStore(str(tmp_path / 'remote'))
+    cache = FileCache(str(tmp_path / 'cache'), 1024)
+    write_remote_file(store, "data://TimeSeries/test.json", '{"tensor": [[1.0]]}')
+    first_path = cache.get(store, "data://TimeSeries/test.json")
+    write_remote_file(store, "data://TimeSeries/test.json", '{"tensor": [[1.0], [2.0]]}')
+    second_path = cache.get(store, "data://TimeSeries/test.json")
+
+    assert first_path != second_path
+    assert cache.stats()['misses'] == 2
+    with open(second_path) as f:
+        assert f.read() == '{"tensor": [[1.0], [2.0]]}'
+
+
+def test_cache_eviction(tmp_path):
+    store = LocalStore(str(tmp_path / 'remote'))
+    cache = FileCache(str(tmp_path / 'cache'), 30)
+    write_remote_file(store, "data://TimeSeries/first.json", 'a' * 20)
+    write_remote_file(store, "data://TimeSeries/second.json", 'b' * 20)
+    first_path = cache.get(store, "data://TimeSeries/first.json")
+    second_path = cache.get(store, "data://TimeSeries/second.json")
+
+    assert not os.path.isfile(first_path)
+    assert os.path.isfile(second_path)
+    assert "data://TimeSeries/first.json" not in cache.load_index()
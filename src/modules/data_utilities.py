@@ -5,42 +5,65 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from src.modules import network_utilities
 
+DEFAULT_QUANTILES = [0.05, 0.5, 0.95]
 
 
 # This catch-all function extracts key parameters from your dataset, and if your `meta_data` object is not defined, populates
 # it with data collected from the dataset, and the input parameters object.
 # If meta_data is already defined, most of those steps are skipped.
-# TODO: clean this up, potentially break out meta_data processing into it's own function.
+# The tensor is copied once into a float32 array, which is normalized in place and handed to torch as is.
 def process_input(data: dict, parameters, meta_data: dict = None):
     tensor = data['tensor']
-    tensor = np.asarray(tensor, dtype=np.float64)
+    tensor = np.array(tensor, dtype=np.float32)
+    if parameters.mode != 'forecast' and len(tensor.shape) != 2:
+        raise network_utilities.AlgorithmError("training requires a tensor of shape [sequence, variables]")
     if meta_data:
         if parameters.forecast_length:
             meta_data['forecast_length'] = parameters.forecast_length
+        if parameters.mode == 'train':
+            update_training_meta_data(meta_data, parameters)
     else:
         meta_data = dict()
-        meta_data['training_time'] = parameters.training_time
+        update_training_meta_data(meta_data, parameters)
         if 'key_variables' in data:
             meta_data['key_variables'] = data['key_variables']
         else:
             meta_data['key_variables'] = None
         meta_data['io_dimension'] = tensor.shape[1]
         meta_data['norm_boundaries'] = calc_norm_boundaries(tensor, meta_data['io_dimension'])
-
-        new_architecture = define_network_geometry(parameters.model_complexity,
-                                                   meta_data['io_dimension'])
-        tensor_shape = {'memory': (new_architecture['recurrent']['depth'],
-                                   1, new_architecture['recurrent']['output']),
-                        'residual': (1, 1, new_architecture['recurrent']['output'])}
-        meta_data['architecture'] = new_architecture
-        meta_data['tensor_shape'] = tensor_shape
-        meta_data['complexity'] = parameters.model_complexity
-        meta_data['io_noise'] = parameters.io_noise
+        update_model_meta_data(meta_data, parameters.model_complexity, parameters.io_noise)
         meta_data['forecast_length'] = parameters.forecast_length
     normalized_data = normalize_and_remove_outliers(tensor, parameters.outlier_removal_multiplier, meta_data)
     return normalized_data, meta_data
 
 
+# Training settings only apply to the training run they were requested for, so they're updated on every retrain.
+def update_training_meta_data(meta_data: dict, parameters):
+    meta_data['training_time'] = parameters.training_time
+    meta_data['window_length'] = parameters.window_length
+    meta_data['burn_in'] = parameters.burn_in
+    meta_data['batch_size'] = parameters.batch_size
+    meta_data['truncation_length'] = parameters.truncation_length
+    meta_data['checkpoint_rollouts'] = parameters.checkpoint_rollouts
+    meta_data['validation_fraction'] = parameters.validation_fraction
+    meta_data['patience'] = parameters.patience
+    return meta_data
+
+
+# Defines the network architecture for a model complexity, along with the shapes of the state tensors that go with it.
+# Requires the 'io_dimension' of the meta_data object to be set.
+def update_model_meta_data(meta_data: dict, complexity: float, io_noise: float):
+    new_architecture = define_network_geometry(complexity, meta_data['io_dimension'])
+    tensor_shape = {'memory': (new_architecture['recurrent']['depth'],
+                               1, new_architecture['recurrent']['output']),
+                    'residual': (1, 1, new_architecture['recurrent']['output'])}
+    meta_data['architecture'] = new_architecture
+    meta_data['tensor_shape'] = tensor_shape
+    meta_data['complexity'] = complexity
+    meta_data['io_noise'] = io_noise
+    return meta_data
+
+
 #    This function takes your complexity parameters, and other things that define your dataset, to automatically generate
 #    the width of certain types of layers, and the number of layers in your recurrent module.
 #    TODO: `complexity` right now only effects recurrent module depth, but it should influence layer width as well.
@@ -71,68 +94,76 @@ def define_network_geometry(complexity: float,  io_dimensions: int):
 # We first remove outliers based on the new dataset.
 # However, we normalize based on the original training data.
 # This is to make sure we're consistent in values fed into the network.
+# Both steps are done in place on `data`.
 def normalize_and_remove_outliers(data: np.ndarray, multiplier: float, meta_data: dict):
     mean = np.mean(data, axis=0)
     sd = np.std(data, axis=0)
-    dimensions = meta_data['io_dimension']
-    norm_boundaries = meta_data['norm_boundaries']
-    for i in range(dimensions):
-        max_delta = mean[i] + multiplier * sd[i]
-        for j in range(data.shape[0]):
-            element = data[j, i]
-            if element > max_delta:
-                print('clipped {} for being too far above the mean.'.format(str(data[j, i])))
-                data[j, i] = max_delta
-            elif element < -max_delta:
-                print('clipped {} for being too far below the mean.'.format(str(data[j, i])))
-                data[j, i] = -max_delta
-    for i in range(dimensions):
-        numerator = np.subtract(data[:, i], norm_boundaries[i]['min'])
-        data[:, i] = np.divide(numerator, norm_boundaries[i]['max'] - norm_boundaries[i]['min'])
+    max_delta = mean + multiplier * sd
+    above = data > max_delta
+    below = np.logical_and(data < -max_delta, np.logical_not(above))
+    num_above = int(np.count_nonzero(above))
+    num_below = int(np.count_nonzero(below))
+    if num_above or num_below:
+        print('clipped {} values for being too far above the mean, and {} for being too far below.'
+              .format(str(num_above), str(num_below)))
+        np.copyto(data, max_delta, where=above)
+        np.copyto(data, -max_delta, where=below)
+    minimums, maximums = norm_boundary_arrays(meta_data['norm_boundaries'])
+    data -= minimums
+    data /= maximums - minimums
 
     return data
 
 def calc_norm_boundaries(data: np.ndarray, dimensions: int):
-    norm_boundaries = list()
-    for i in range(dimensions):
-        max = np.max(data[:, i], axis=0)
-        min = np.min(data[:, i], axis=0)
-        norm_boundaries.append({'max': max, 'min': min})
+    maximums = np.max(data[:, :dimensions], axis=0).tolist()
+    minimums = np.min(data[:, :dimensions], axis=0).tolist()
+    norm_boundaries = [{'max': max, 'min': min} for max, min in zip(maximums, minimums)]
     return norm_boundaries
 
 
+# Converts the per-column "norm_boundaries" list from the meta_data object into arrays that can be broadcast over a tensor.
+def norm_boundary_arrays(norm_boundaries: list):
+    minimums = np.asarray([boundary['min'] for boundary in norm_boundaries], dtype=np.float64)
+    maximums = np.asarray([boundary['max'] for boundary in norm_boundaries], dtype=np.float64)
+    return minimums, maximums
+
+
 # Used for reverting the normalization process for forecasts.
 # The "norm_boundaries" variables are defined in the meta_data object.
 # maps the tensors values back to the original representation
 def revert_normalization(data: np.ndarray, meta_data: dict):
-    norm_boundaries = meta_data['norm_boundaries']
+    minimums, maximums = norm_boundary_arrays(meta_data['norm_boundaries'])
     if meta_data['key_variables']:
         variables = [index['index'] for index in meta_data['key_variables']]
-        num_vars = len(variables)
+        minimums = minimums[variables]
+        maximums = maximums[variables]
     else:
-        variables = range(data.shape[1])
-        num_vars = data.shape[1]
-
-    output = np.empty(data.shape, float)
-    for i in range(num_vars):
-        index = variables[i]
-        min = norm_boundaries[index]['min']
-        max = norm_boundaries[index]['max']
-        multiplier = max-min
-        intermediate = np.multiply(data[:, i], multiplier)
-        result = np.add(intermediate, min)
-        output[:, i] = result
+        minimums = minimums[:data.shape[-1]]
+        maximums = maximums[:data.shape[-1]]
+
+    output = data * (maximums - minimums) + minimums
     return output
 
 
 # Prepares the raw output from our forecast operation for export to the user.
 # uses the variable Headers to label the dimension appropriately.
-def format_forecast(forecast: np.ndarray, meta_data: dict):
+# A forecast of many samples, of shape [samples, forecast_length, variables], is summarized by the mean and `quantiles`
+# of its samples, each of which is labelled like a single forecast.
+def format_forecast(forecast: np.ndarray, meta_data: dict, quantiles: list = None):
     true_forecast = revert_normalization(forecast, meta_data)
+    if len(forecast.shape) == 3:
+        quantiles = quantiles or DEFAULT_QUANTILES
+        bands = np.quantile(true_forecast, quantiles, axis=0)
+        return {'mean': label_forecast(true_forecast.mean(axis=0), meta_data),
+                'quantiles': {str(quantile): label_forecast(band, meta_data) for quantile, band in zip(quantiles, bands)}}
+    return label_forecast(true_forecast, meta_data)
+
+
+def label_forecast(true_forecast: np.ndarray, meta_data: dict):
     if meta_data['key_variables']:
         feature_columns = [key_var['header'] for key_var in  meta_data['key_variables']]
     else:
-        feature_columns = list(range(forecast.shape[1]))
+        feature_columns = list(range(true_forecast.shape[1]))
     result = dict()
     for i in range(len(feature_columns)):
         header = feature_columns[i]
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from src.modules import model_manager
+
+RESULT_FILE_NAME = 'result.pt'
+
+
+def train_model(model, meta_data: dict, data: np.ndarray, workers: int):
+    r"""
+    Trains `model` on `data` with `workers` processes on this machine, using data parallelism.
+
+    Every process holds a copy of the network, and at every training step works on its own share of the batch:
+    with `window_length` each process samples its own windows, otherwise each process rolls out the forecasts from
+    its own share of the timesteps. Gradients are then summed across the processes with the gloo backend,
+    so that every copy of the network takes the same optimizer step.
+
+    The first process decides when to stop, so `training_time` and early stopping behave as they do in a single
+    process, once training is done its network and optimizer state are copied back into `model`.
+    Returns the best loss, like `Model.train_model`.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        init_method = 'file://{}'.format(os.path.join(directory, 'rendezvous'))
+        result_path = os.path.join(directory, RESULT_FILE_NAME)
+        tensor = torch.from_numpy(data).share_memory_()
+        weights = {name: weights.detach().clone() for name, weights in model.network.state_dict().items()}
+        optimizer_state = model.extract_optimizer_state()
+        seed = int(torch.randint(0, 2 ** 31, (1,)).item())
+        mp.spawn(worker, args=(workers, init_method, meta_data, weights, optimizer_state, tensor, seed, result_path),
+                 nprocs=workers, join=True)
+        result = torch.load(result_path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    model.network.load_state_dict(result['network'])
+    model.optimizer.load_state_dict(result['optimizer'])
+    return result['loss']
+
+
+# The entry point of every training process.
+def worker(rank: int, world_size: int, init_method: str, meta_data: dict, weights: dict, optimizer_state: dict,
+           tensor: torch.Tensor, seed: int, result_path: str):
+    model_manager.share_intra_op_threads(world_size)
+    torch.manual_seed(seed + rank)
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        model = model_manager.Model(meta_data, optimizer_state=optimizer_state)
+        model.network.load_state_dict(weights)
+        model.rank = rank
+        model.world_size = world_size
+        loss = model.train_model(tensor.numpy())
+        if rank == 0:
+            torch.save({'loss': loss, 'network': model.network.state_dict(),
+                        'optimizer': model.extract_optimizer_state()}, result_path)
+    finally:
+        dist.destroy_process_group()
@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+from typing import List
 
 class ForecastNetwork(torch.jit.ScriptModule):
 
@@ -35,30 +36,33 @@ class ForecastNetwork(torch.jit.ScriptModule):
 
 
     Where the shape of each layer and module is defined in the `data_utilities.define_network_geometry()` function.
+    The layers are built by `build_layers()`, unless already built ones are passed in as `layers`.
     """
 
-    def __init__(self, architecture):
+    def __init__(self, architecture, layers: tuple = None):
         super(ForecastNetwork, self).__init__()
         linear_in_input_shape = architecture['linear_in']['input']
-        linear_in_output_shape = architecture['linear_in']['output']
         linear_out_input_shape = architecture['linear_out']['input']
-        linear_out_output_shape = architecture['linear_out']['output']
         memory_input_shape = architecture['recurrent']['input']
         memory_output_shape = architecture['recurrent']['output']
         memory_depth_shape = architecture['recurrent']['depth']
-        linear_in = nn.Linear(linear_in_input_shape, linear_in_output_shape)
-        recurrent = nn.GRU(memory_input_shape, memory_output_shape, memory_depth_shape)
-        linear_out = nn.Linear(linear_out_input_shape, linear_out_output_shape)
+        if layers:
+            linear_in, recurrent, linear_out = layers
+        else:
+            linear_in, recurrent, linear_out = build_layers(architecture)
 
-        self.linear_in = torch.jit.trace(linear_in, example_inputs=(torch.randn(linear_in_input_shape)))
+        self.linear_in = torch.jit.trace(linear_in, example_inputs=(torch.randn(1, linear_in_input_shape)))
         self.recurrent = torch.jit.trace(recurrent, example_inputs=(torch.randn(1, 1, memory_input_shape), torch.randn(memory_depth_shape, 1, memory_output_shape)))
         self.linear_out = torch.jit.trace(linear_out, example_inputs=(torch.randn(1, 1, linear_out_input_shape)))
 
+    # The batch dimension is taken from the memory tensor, so a single step can be run for many independent
+    # sequences at once, as long as `input` has one row per memory state.
     @torch.jit.script_method
     def forward(self, input: torch.Tensor, residual: torch.Tensor, memory: torch.Tensor):
-        input = input.view(-1)
+        batch_size = memory.size(1)
+        input = input.view(batch_size, -1)
         processed_input = self.linear_in(input)
-        processed_input = processed_input.view(1, 1, -1)
+        processed_input = processed_input.view(1, batch_size, -1)
         rnn_out, memory = self.recurrent(processed_input, memory)
         rnn_merged = rnn_out + residual
         residual = self.update_residual(rnn_out, residual)
@@ -66,6 +70,69 @@ class ForecastNetwork(torch.jit.ScriptModule):
 
         return output, residual, memory
 
+    # Runs a whole [sequence, batch, io_dimension] tensor through the network, the linear layers and the recurrent
+    # module are each applied once to the full sequence, only the residual accumulator is stepped through in order.
+    @torch.jit.script_method
+    def forward_sequence(self, input: torch.Tensor, residual: torch.Tensor, memory: torch.Tensor):
+        processed_input = self.linear_in(input)
+        rnn_out, memory = self.recurrent(processed_input, memory)
+        rnn_merged, residuals = self.accumulate_residual(rnn_out, residual)
+        residual = residuals[-1].unsqueeze(0)
+        output = self.linear_out(rnn_merged)
+
+        return output, residual, memory
+
+    # Like `forward_sequence`, but also returns the residual and memory state of every timestep,
+    # of shape [sequence, batch, memory] and [sequence, depth, batch, memory] respectively.
+    # The recurrent module only exposes the state of every layer at the end of a sequence,
+    # so deeper networks have to be stepped through one timestep at a time.
+    @torch.jit.script_method
+    def forward_states(self, input: torch.Tensor, residual: torch.Tensor, memory: torch.Tensor):
+        processed_input = self.linear_in(input)
+        if memory.size(0) == 1:
+            rnn_out, memory = self.recurrent(processed_input, memory)
+            memories = rnn_out.unsqueeze(1)
+        else:
+            rnn_outs = torch.jit.annotate(List[torch.Tensor], [])
+            memory_states = torch.jit.annotate(List[torch.Tensor], [])
+            for t in range(processed_input.size(0)):
+                rnn_out_t, memory = self.recurrent(processed_input.narrow(0, t, 1), memory)
+                rnn_outs.append(rnn_out_t)
+                memory_states.append(memory)
+            rnn_out = torch.cat(rnn_outs, 0)
+            memories = torch.stack(memory_states, 0)
+        rnn_merged, residuals = self.accumulate_residual(rnn_out, residual)
+        output = self.linear_out(rnn_merged)
+
+        return output, residuals, memories
+
+    # The autoregressive forecast loop, starting from `last_step` each predicted step is fed back in as the next input.
+    # `noise` is of shape [forecast_length - 1, batch, io_dimension] and is added to every fed back step,
+    # it also defines the forecast horizon, pass zeros for a deterministic forecast.
+    # The output is of shape [batch, forecast_length, io_dimension].
+    @torch.jit.script_method
+    def rollout(self, last_step: torch.Tensor, residual: torch.Tensor, memory: torch.Tensor, noise: torch.Tensor):
+        steps = torch.jit.annotate(List[torch.Tensor], [])
+        steps.append(last_step)
+        x_t = last_step
+        for i in range(noise.size(0)):
+            x_t = x_t + noise[i]
+            next_step, residual, memory = self.forward(x_t, residual, memory)
+            x_t = next_step[0]
+            steps.append(x_t)
+        return torch.stack(steps, 1)
+
+    @torch.jit.script_method
+    def accumulate_residual(self, rnn_out: torch.Tensor, residual: torch.Tensor):
+        merged = torch.jit.annotate(List[torch.Tensor], [])
+        residuals = torch.jit.annotate(List[torch.Tensor], [])
+        for t in range(rnn_out.size(0)):
+            rnn_out_t = rnn_out.narrow(0, t, 1)
+            merged.append(rnn_out_t + residual)
+            residual = self.update_residual(rnn_out_t, residual)
+            residuals.append(residual)
+        return torch.cat(merged, 0), torch.cat(residuals, 0)
+
     @torch.jit.script_method
     def update_residual(self, output, residual):
         residual = residual + output
@@ -73,3 +140,12 @@ class ForecastNetwork(torch.jit.ScriptModule):
         return residual
 
 
+# The untraced linear and recurrent layers of the network, named as they are in its state dict.
+def build_layers(architecture):
+    linear_in = nn.Linear(architecture['linear_in']['input'], architecture['linear_in']['output'])
+    recurrent = nn.GRU(architecture['recurrent']['input'], architecture['recurrent']['output'],
+                       architecture['recurrent']['depth'])
+    linear_out = nn.Linear(architecture['linear_out']['input'], architecture['linear_out']['output'])
+    return linear_in, recurrent, linear_out
+
+
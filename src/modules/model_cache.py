@@ -0,0 +1,113 @@
+import os
+from collections import OrderedDict
+from copy import deepcopy
+from src.modules import network_utilities
+from src.modules.model_manager import InferenceBuffers, upgrade_network, quantize_network, quantization_error
+
+MAX_ENTRIES = 8
+MAX_BYTES = 1024 * 1024 * 1024
+
+
+class ModelCache:
+    r"""
+    An in-process, least recently used cache of loaded model packages.
+    As the algorithm process is kept alive between requests, forecasts against a model we've served recently
+    can skip unzipping and deserializing the torch graph.
+
+    Entries are keyed by the package path and a fingerprint of the package file, see `package_fingerprint`,
+    so overwriting a package at the same path is picked up on the next request. Quantized networks are cached separately from float ones,
+    along with the `quantization` report of how far their forecasts are from the float network's. The cache is bounded both by the number of entries, and by
+    the number of bytes held by the cached network parameters.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, remote_package_path: str, quantized: bool = False):
+        local_file_path = network_utilities.get_package_file(remote_package_path)
+        key = (remote_package_path, package_fingerprint(remote_package_path, local_file_path), quantized)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            network, meta_data, _, _ = self.entries[key]
+        else:
+            self.misses += 1
+            network, meta_data = network_utilities.load_model_package(local_file_path)
+            network = upgrade_network(network, meta_data['architecture'])
+            if quantized:
+                weights, _ = network_utilities.get_package_weights(remote_package_path)
+                quantized_network = quantize_network(weights, meta_data['architecture'])
+                meta_data['quantization'] = quantization_error(network, quantized_network, meta_data)
+                network = quantized_network
+            self.insert(key, network, meta_data)
+        # meta_data is updated with request specific values during processing, so every caller gets their own copy.
+        return network, deepcopy(meta_data)
+
+    def insert(self, key: tuple, network, meta_data: dict):
+        stale_keys = [cached_key for cached_key in self.entries if cached_key[0] == key[0] and cached_key[1] != key[1]]
+        for stale_key in stale_keys:
+            self.evict(stale_key)
+        size = network_size(network, meta_data)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (network, meta_data, size, InferenceBuffers())
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, key: tuple):
+        _, _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    # The buffers to forecast with `network`, kept for as long as it's cached. Networks that aren't cached get new ones.
+    def inference_buffers(self, network):
+        for cached_network, _, _, buffers in self.entries.values():
+            if cached_network is network:
+                return buffers
+        return InferenceBuffers()
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes}
+
+
+# Remote packages are kept in the on-disk data cache under the digest of their contents, so the cached file's name
+# already tells versions apart. Local packages are told apart by their size, modification time and inode,
+# so a cache hit never reads the whole package.
+def package_fingerprint(remote_package_path: str, local_file_path: str):
+    if remote_package_path.startswith('file://'):
+        file_stat = os.stat(local_file_path)
+        return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino
+    return os.path.basename(local_file_path)
+
+
+# Frozen networks hold their weights as graph constants rather than parameters, for those we go by the size of the
+# weights recorded in the package's meta data.
+def network_size(network, meta_data: dict):
+    tensors = list(network.parameters()) + list(network.buffers())
+    size = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    if not size:
+        size = meta_data.get('weights_bytes', 0)
+    return size
+
+
+cache = ModelCache()
+
+
+def get_model_package(remote_package_path: str, quantized: bool = False):
+    return cache.get(remote_package_path, quantized)
+
+
+def get_inference_buffers(network):
+    return cache.inference_buffers(network)
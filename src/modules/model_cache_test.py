@@ -0,0 +1,89 @@
+import numpy as np
+from src.OpenForecast import Parameters
+from src.modules import data_utilities, model_manager, network_utilities
+from src.modules.data_store import LocalStore
+from src.modules.model_cache import ModelCache
+
+
+def save_test_package(remote_path):
+    parameters = Parameters()
+    parameters.forecast_length = 4
+    parameters.model_complexity = 0.1
+    data = {'tensor': np.random.rand(30, 2).tolist()}
+    _, meta_data = data_utilities.process_input(data, parameters)
+    network = model_manager.init_network(meta_data['architecture'])
+    return network_utilities.save_model_package(network, meta_data, remote_path)
+
+
+def test_cache_hit():
+    path = "file://tmp/model_cache_test_0.zip"
+    save_test_package(path)
+    cache = ModelCache()
+    cache.get(path)
+    _, meta_data = cache.get(path)
+
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    meta_data['forecast_length'] = 100
+    _, meta_data = cache.get(path)
+    assert meta_data['forecast_length'] == 4
+
+
+def test_cache_reloads_overwritten_package():
+    path = "file://tmp/model_cache_test_1.zip"
+    save_test_package(path)
+    cache = ModelCache()
+    cache.get(path)
+    save_test_package(path)
+    cache.get(path)
+
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['entries'] == 1
+
+
+def test_cache_remote_package(tmp_path, monkeypatch):
+    monkeypatch.setattr(network_utilities, 'store', LocalStore(str(tmp_path)))
+    path = "data://TimeSeries/model_cache_test.zip"
+    save_test_package(path)
+    cache = ModelCache()
+    cache.get(path)
+    cache.get(path)
+
+    assert cache.stats()['hits'] == 1
+    save_test_package(path)
+    cache.get(path)
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['entries'] == 1
+
+
+def test_cache_bounds():
+    first_path = "file://tmp/model_cache_test_2.zip"
+    second_path = "file://tmp/model_cache_test_3.zip"
+    save_test_package(first_path)
+    save_test_package(second_path)
+    cache = ModelCache(max_entries=1)
+    cache.get(first_path)
+    cache.get(second_path)
+    cache.get(first_path)
+
+    assert cache.stats()['misses'] == 3
+    assert cache.stats()['entries'] == 1
+    cache = ModelCache(max_bytes=1)
+    cache.get(first_path)
+    assert cache.stats()['entries'] == 0
+
+
+def test_cache_keeps_inference_buffers():
+    path = "file://tmp/model_cache_test_4.zip"
+    save_test_package(path)
+    cache = ModelCache()
+    network, meta_data = cache.get(path)
+    buffers = cache.inference_buffers(network)
+    tensor = np.random.rand(10, 2)
+    model_manager.Model(meta_data, network, buffers=buffers).forecast(tensor)
+    pointers = [buffer.data_ptr() for buffer in buffers.buffers.values()]
+    network, meta_data = cache.get(path)
+
+    assert cache.inference_buffers(network) is buffers
+    model_manager.Model(meta_data, network, buffers=cache.inference_buffers(network)).forecast(tensor)
+    assert [buffer.data_ptr() for buffer in buffers.buffers.values()] == pointers
@@ -1,42 +1,126 @@
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 
 import torch
+import torch.distributed as dist
 import numpy as np
 from torch import nn
 from torch import optim
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from torch import from_numpy
-from src.modules.forecast_model import ForecastNetwork
+from src.modules.forecast_model import ForecastNetwork, build_layers
+from src.modules import network_utilities, profiling
+from src.modules.profiling import record_function
+
+NETWORK_METHODS = ['forward_sequence', 'forward_states', 'rollout']
+# The number of steps of random history, and of forecast, used to compare a quantized network against its float one.
+QUANTIZATION_PROBE_LENGTH = 16
+# Dynamic quantization needs torch 1.3 or newer.
+QUANTIZATION_SUPPORTED = hasattr(torch, 'quantization') and hasattr(torch.quantization, 'quantize_dynamic')
+# Newer versions of torch warn unless checkpointing is told which implementation to use, older ones don't take the argument.
+# The non-reentrant implementation can't recompute the network's script methods.
+CHECKPOINT_ARGUMENTS = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+# The relative decrease in loss that counts as an improvement, for early stopping and learning rate scheduling.
+IMPROVEMENT_THRESHOLD = 1e-4
+# The number of buffers kept by `InferenceBuffers`, one for every shape of request.
+MAX_INFERENCE_BUFFERS = 8
 
 class GaussianNoise:
-    def __init__(self, stddev: float):
+    def __init__(self, stddev: float, generator: torch.Generator = None):
         super(GaussianNoise, self).__init__()
         self.stddev = stddev
+        self.generator = generator
 
     def add_noise(self, din):
-        rng = torch.autograd.Variable(torch.randn(din.size()) * self.stddev).float()
+        if not self.stddev:
+            return din
+        rng = torch.autograd.Variable(torch.randn(din.size(), generator=self.generator) * self.stddev).float()
         return din + rng
 
+    def sample(self, shape: tuple):
+        if not self.stddev:
+            return torch.zeros(shape)
+        return torch.randn(shape, generator=self.generator) * self.stddev
+
+
+class InferenceBuffers:
+    r"""
+    The buffers of the noise added to the forecast horizon, allocated once for every shape of request,
+    and refilled in place by every later forecast of the same shape, rather than allocated by every step.
+    The model cache keeps them alongside the cached network, so they're reused across requests for as long as the
+    network stays cached. At most `max_buffers` are kept, the least recently used are dropped first.
+    The noise added to the input isn't buffered, as it's the size of the whole history of the request, and would stay
+    allocated long after the request is served.
+
+    The noise of the whole forecast horizon is drawn in a single call, from the noise's generator when it's seeded.
+    Buffers are refilled by the next forecast, so forecasts hold `lock` for as long as they use them.
+    """
+
+    def __init__(self, max_buffers: int = MAX_INFERENCE_BUFFERS):
+        self.max_buffers = max_buffers
+        self.buffers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def buffer(self, name: str, shape: tuple):
+        key = (name, tuple(shape))
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+        else:
+            self.buffers[key] = torch.empty(shape)
+            while len(self.buffers) > self.max_buffers:
+                self.buffers.popitem(last=False)
+        return self.buffers[key]
+
+    def horizon_noise(self, shape: tuple, noise: GaussianNoise):
+        buffer = self.buffer('horizon', shape)
+        if noise.stddev:
+            buffer.normal_(0, noise.stddev, generator=noise.generator)
+        else:
+            buffer.zero_()
+        return buffer
 
 
 
 class Model:
 
 
-    def __init__(self, meta_data, network=None):
+    def __init__(self, meta_data, network=None, optimizer_state=None, buffers: InferenceBuffers = None):
         self.residual_shape = meta_data['tensor_shape']['residual']
         self.memory_shape = meta_data['tensor_shape']['memory']
         self.data_dimensionality = meta_data['io_dimension']
         self.key_variables = meta_data['key_variables']
+        self.key_index = key_variable_index(self.key_variables)
         self.forecast_length = meta_data['forecast_length']
         self.training_time = meta_data['training_time']
+        self.window_length = meta_data.get('window_length')
+        self.burn_in = meta_data.get('burn_in') or 0
+        self.batch_size = meta_data.get('batch_size') or 1
+        self.truncation_length = meta_data.get('truncation_length')
+        self.checkpoint_rollouts = meta_data.get('checkpoint_rollouts') or False
+        self.validation_fraction = meta_data.get('validation_fraction')
+        self.patience = meta_data.get('patience')
+        self.rank = 0
+        self.world_size = 1
         self.noise = GaussianNoise(meta_data['io_noise'])
+        self.buffers = buffers or InferenceBuffers()
         if network:
-            self.network = network
+            self.network = upgrade_network(network, meta_data['architecture'])
         else:
             self.network = init_network(meta_data['architecture'])
+        # Frozen inference networks have no parameters, and can only forecast.
+        parameters = list(self.network.parameters())
+        self.optimizer = optim.Adam(parameters, lr=35e-4) if parameters else None
+        if optimizer_state and self.optimizer:
+            self.optimizer.load_state_dict(optimizer_state)
 
-    def forecast(self, data: np.ndarray):
+    def forecast(self, data: np.ndarray, states: list = None, num_samples: int = 1, threads: int = 1):
         r"""
         By comparison with training, the forecast process is might simpler.
 
@@ -79,16 +163,88 @@ class Model:
         - `n` is the last element in the timeseries sequence
         - `t` is the timeseries step variable
 
+        `data` is either a single sequence of shape [sequence, io_dimension], or a batch of equal length sequences
+        of shape [sequence, batch, io_dimension] which are forecast together, in which case the output has a leading batch dimension.
+
+        `states` optionally provides a starting state for every sequence in the batch, as created by `export_state`,
+        which lets `data` contain only the timesteps that came after that state. None starts a sequence from scratch.
+
+        With `num_samples`, every sequence is forecast that many times with different noise, and the output has
+        a samples dimension before the forecast length. The samples are forecast together in the batch dimension.
+
+        With `threads`, the batch of sequences and samples is split into that many chunks, forecast concurrently.
         """
 
+        numpy_forecast, _, _ = self.forecast_with_state(data, states, num_samples, threads)
+        return numpy_forecast
+
+    # Like `forecast`, but also returns the residual and memory state after the last timestep of `data`,
+    # with many samples, the state of the first sample of every sequence is returned.
+    def forecast_with_state(self, data: np.ndarray, states: list = None, num_samples: int = 1, threads: int = 1):
         tensor = convert_to_torch_tensor(data)
-        init_residual = generate_state(self.residual_shape)
-        init_memory = generate_state(self.memory_shape)
-        last_step, checkpoint_residual, checkpoint_memory = self.update(init_residual, init_memory, tensor)
-        raw_forecast = self.forecast_step(checkpoint_residual, checkpoint_memory, last_step)
+        batch_size = tensor.shape[1] if len(tensor.shape) == 3 else 1
+        tensor = tensor.view(tensor.shape[0], batch_size, -1)
+        init_residual, init_memory = self.initial_state(states, batch_size)
+        if num_samples > 1:
+            tensor = repeat_samples(tensor, num_samples)
+            init_residual = repeat_samples(init_residual, num_samples)
+            init_memory = repeat_samples(init_memory, num_samples)
+        if threads > 1 and tensor.shape[1] > 1:
+            raw_forecast, checkpoint_residual, checkpoint_memory = self.forecast_chunks(tensor, init_residual,
+                                                                                        init_memory, threads)
+        else:
+            raw_forecast, checkpoint_residual, checkpoint_memory = self.forecast_chunk(tensor, init_residual,
+                                                                                       init_memory)
         filtered_forecast = self.select_key_variables(raw_forecast)
         numpy_forecast = filtered_forecast.detach().numpy()
-        return numpy_forecast
+        if num_samples > 1:
+            numpy_forecast = numpy_forecast.reshape((batch_size, num_samples) + numpy_forecast.shape[1:])
+            checkpoint_residual = checkpoint_residual[:, ::num_samples]
+            checkpoint_memory = checkpoint_memory[:, ::num_samples]
+        if len(data.shape) == 2:
+            numpy_forecast = numpy_forecast[0]
+        return numpy_forecast, checkpoint_residual.detach(), checkpoint_memory.detach()
+
+    # No autograd graph is recorded while forecasting, as nothing is ever backpropagated through it.
+    def forecast_chunk(self, tensor: torch.Tensor, residual: torch.Tensor, memory: torch.Tensor):
+        with torch.no_grad(), self.buffers.lock:
+            with profiling.phase('update'):
+                last_step, residual, memory = self.update(residual, memory, tensor)
+            with profiling.phase('forecast_step'):
+                raw_forecast = self.forecast_step(residual, memory, last_step)
+        return raw_forecast, residual, memory
+
+    # Splits the batch into chunks that are forecast on a pool of threads, torch releases the GIL while it computes,
+    # so the chunks run in parallel. When the noise is seeded, every chunk gets its own generator seeded from it,
+    # so the forecasts don't depend on how the threads get scheduled.
+    def forecast_chunks(self, tensor: torch.Tensor, residual: torch.Tensor, memory: torch.Tensor, threads: int):
+        chunks = list(zip(tensor.chunk(threads, dim=1), residual.chunk(threads, dim=1), memory.chunk(threads, dim=1)))
+        models = [copy(self) for _ in chunks]
+        for model in models:
+            generator = None
+            if self.noise.generator:
+                seed = int(torch.randint(0, 2 ** 62, (1,), generator=self.noise.generator).item())
+                generator = torch.Generator().manual_seed(seed)
+            model.noise = GaussianNoise(self.noise.stddev, generator)
+            model.buffers = InferenceBuffers()
+        with ThreadPoolExecutor(len(chunks)) as executor:
+            results = list(executor.map(lambda model, chunk: model.forecast_chunk(*chunk), models, chunks))
+        raw_forecasts, residuals, memories = zip(*results)
+        return torch.cat(raw_forecasts, dim=0), torch.cat(residuals, dim=1), torch.cat(memories, dim=1)
+
+    # Makes the noise added while forecasting reproducible.
+    def seed_noise(self, seed: int):
+        self.noise.generator = torch.Generator().manual_seed(seed)
+
+    # The state of the whole batch is allocated at once, and only the sequences that have a state are copied into it.
+    def initial_state(self, states: list, batch_size: int):
+        residual = generate_state(self.residual_shape, batch_size)
+        memory = generate_state(self.memory_shape, batch_size)
+        for b, state in enumerate(states or []):
+            if state:
+                residual[:, b:b + 1].copy_(state['residual'])
+                memory[:, b:b + 1].copy_(state['memory'])
+        return residual, memory
 
     def train_model(self, data: np.ndarray):
 
@@ -149,99 +305,400 @@ class Model:
 
         tensor = convert_to_torch_tensor(data)
         criterion = nn.MSELoss()
-        parameters = self.network.parameters()
-        optimizer = optim.Adam(parameters, lr=35e-4)
-        x, y = self.segment_data(tensor)
+        optimizer = self.optimizer
+        if self.validation_fraction:
+            validation_length = int(tensor.shape[0] * self.validation_fraction)
+            if validation_length <= self.forecast_length + 1:
+                raise network_utilities.AlgorithmError("the validation tail ({} steps) must be longer than the forecast "
+                                                       "length".format(str(validation_length)))
+            x_validation, y_validation = self.segment_data(tensor[-validation_length:])
+            tensor = tensor[:-validation_length]
+            validation_burn_in = tensor[tensor.shape[0] - min(self.burn_in, tensor.shape[0]):]
+        if self.window_length:
+            window_span = self.burn_in + self.window_length + self.forecast_length + 1
+            if window_span > tensor.shape[0]:
+                raise network_utilities.AlgorithmError("the training windows, burn in and forecast length ({} steps) don't "
+                                                       "fit in the training data ({} steps)"
+                                                       .format(str(window_span), str(tensor.shape[0])))
+        else:
+            x, y = self.segment_data(tensor)
+        if self.patience:
+            scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5, patience=max(1, self.patience // 2))
+        best_loss = None
+        best_weights = None
+        steps_since_improvement = 0
+        steps = 0
+        torch_profile = profiling.start_torch_profile('training')
         start = perf_counter()
         total_time = 0
-        while True:
-            if total_time >= self.training_time:
-                break
+        stop = total_time >= self.training_time
+        while not stop:
             optimizer.zero_grad()
+            with record_function('sample_batch'):
+                if self.window_length:
+                    x, y, residual, memory = self.sample_windows(tensor)
+                else:
+                    residual = generate_state(self.residual_shape)
+                    memory = generate_state(self.memory_shape)
+            with record_function('backpropagate'):
+                loss_cpu = self.backpropagate(residual, memory, x, y, criterion)
+            if self.world_size > 1:
+                with record_function('all_reduce'):
+                    all_reduce_gradients(self.network)
+                    loss_cpu = all_reduce_sum(loss_cpu)
+            self.log('training loss: {}'.format(str(loss_cpu)))
+            with record_function('optimizer_step'):
+                optimizer.step()
+            if self.validation_fraction:
+                with record_function('validation'):
+                    loss_cpu = self.validation_loss(validation_burn_in, x_validation, y_validation, criterion)
+                self.log('validation loss: {}'.format(str(loss_cpu)))
+            if self.patience:
+                scheduler.step(loss_cpu)
+            if best_loss is None or loss_cpu < best_loss * (1 - IMPROVEMENT_THRESHOLD):
+                best_loss = loss_cpu
+                best_weights = {name: weights.detach().clone() for name, weights in self.network.state_dict().items()}
+                steps_since_improvement = 0
+            else:
+                steps_since_improvement += 1
+            steps += 1
+            if steps == profiling.torch_profile_steps():
+                summary_start = perf_counter()
+                profiling.stop_torch_profile(torch_profile)
+                # Summarizing the torch profile isn't training, so it doesn't count towards the training time.
+                start += perf_counter() - summary_start
+            total_time = perf_counter() - start
+            self.log("current training time: {}s".format(str(total_time)))
+            stop = total_time >= self.training_time
+            if self.patience and steps_since_improvement >= self.patience:
+                self.log('stopping early, the loss has not improved in {} steps'.format(str(steps_since_improvement)))
+                stop = True
+            # Every process has to agree on when to stop, so the first process keeps the time for all of them.
+            if self.world_size > 1:
+                stop = broadcast_flag(stop)
+        profiling.stop_torch_profile(torch_profile)
+        if best_weights:
+            self.network.load_state_dict(best_weights)
+        if steps:
+            profiling.record('training', {'steps': steps, 'steps_per_second': steps / total_time,
+                                          'time_per_step': total_time / steps})
+        self.log('best training loss: {}'.format(str(best_loss)))
+        return best_loss
+
+    # The loss on the validation tail, starting from the state after the `burn_in` steps right before it, like a training
+    # window, so that validating costs the same at every step however long the training data is.
+    def validation_loss(self, burn_in, x, y, criterion):
+        with torch.no_grad():
             residual = generate_state(self.residual_shape)
             memory = generate_state(self.memory_shape)
-            h, residual, memory = self.forecast_every_step(residual, memory, x)
-            y_f = self.select_key_variables(y)
-            h_f = self.select_key_variables(h)
-            loss = criterion(h_f, y_f)
-            loss_cpu = loss.item()
-            print('training loss: {}'.format(str(loss_cpu)))
-            loss.backward()
-            optimizer.step()
-            total_time = perf_counter() - start
-            print("current training time: {}s".format(str(total_time)))
-        print('best training loss: {}'.format(str(loss_cpu)))
+            if burn_in.shape[0]:
+                _, residual, memory = self.network.forward_sequence(burn_in.view(burn_in.shape[0], 1, -1), residual,
+                                                                    memory)
+            loss, _, _ = self.shard_loss(residual, memory, x, y, criterion, self.shard_positions(x))
+        loss_cpu = loss.item()
+        if self.world_size > 1:
+            loss_cpu = all_reduce_sum(loss_cpu)
         return loss_cpu
 
+    # Computes the loss over `x` and accumulates its gradients.
+    # If a truncation length is set, the sequence is processed in chunks of that many timesteps, with the state
+    # detached between chunks, so the autograd graph (and memory use) never spans more than one chunk.
+    # Chunk losses are weighted by their length, so the reported loss and the gradients match an untruncated pass.
+    # When training is distributed, the loss is this process's share of it, so that summing the gradients of
+    # every process gives the gradient of the whole batch.
+    def backpropagate(self, residual, memory, x, y, criterion):
+        chunk_length = self.truncation_length or x.shape[0]
+        total_loss = 0
+        for chunk_start in range(0, x.shape[0], chunk_length):
+            x_chunk = x[chunk_start:chunk_start + chunk_length]
+            y_chunk = y[chunk_start:chunk_start + chunk_length]
+            if self.window_length:
+                positions = None
+            else:
+                positions = self.shard_positions(x_chunk)
+            with record_function('forward'):
+                loss, residual, memory = self.shard_loss(residual, memory, x_chunk, y_chunk, criterion, positions)
+                loss = loss * (x_chunk.shape[0] / x.shape[0])
+            with record_function('backward'):
+                loss.backward()
+            total_loss += loss.item()
+            residual = residual.detach()
+            memory = memory.detach()
+        return total_loss
+
+    # The loss of the forecasts made from every step of `x`, weighted by the share of the batch this process holds.
+    # With `positions`, only the forecasts made from those steps are rolled out, for a batch of sequences
+    # the positions index the flattened [sequence * batch] steps.
+    def shard_loss(self, residual, memory, x, y, criterion, positions=None):
+        h, residual, memory = self.forecast_every_step(residual, memory, x, positions)
+        if positions is None:
+            share = 1 / self.world_size
+        else:
+            y = select_positions(y, positions)
+            share = positions.numel() / (x.numel() // self.data_dimensionality)
+        loss = self.key_variable_loss(criterion, h, y) * share
+        return loss, residual, memory
+
+    # The loss is only taken over the key variables, `y` is usually a view of the training data from `segment_data`,
+    # so only its key variable columns are ever copied out of it.
+    def key_variable_loss(self, criterion, h: torch.Tensor, y: torch.Tensor):
+        return criterion(self.select_key_variables(h), self.select_key_variables(y))
+
+    # When training on a single sequence is distributed, each process rolls out the forecasts from every
+    # `world_size`th step of `x`. Returns None when every process should roll out every step.
+    def shard_positions(self, x: torch.Tensor):
+        step_count = x.numel() // self.data_dimensionality
+        if self.world_size == 1 or step_count < self.world_size:
+            return None
+        return torch.arange(self.rank, step_count, self.world_size)
+
+    def log(self, message: str):
+        if self.rank == 0:
+            print(message)
+
     def extract_network(self):
         return self.network
 
-    def forecast_every_step(self, residual, memory, x):
-        h = []
-        for i in range(len(x)):
-            x_t = x[i].view(1, -1)
-            h_t, residual, memory = self.network(x_t, residual, memory)
-            h_n = self.forecast_step(residual, memory, h_t[-1])
-            h.append(h_n)
-        h = torch.stack(h)
+    def extract_optimizer_state(self):
+        return self.optimizer.state_dict()
+
+    # The teacher-forced pass collects the state at every timestep, those states are then stacked along the batch
+    # dimension so that every per-timestep forecast is rolled out together, rather than one timestep at a time.
+    # `x` is either a single sequence [sequence, io_dimension], or a batch of them [sequence, batch, io_dimension],
+    # in which case `h` is of shape [sequence, batch, forecast_length, io_dimension].
+    # With `positions`, only the forecasts from those of the flattened [sequence * batch] steps are rolled out,
+    # and `h` is of shape [positions, forecast_length, io_dimension].
+    def forecast_every_step(self, residual, memory, x, positions=None):
+        sequence_length = x.shape[0]
+        is_batch = len(x.shape) == 3
+        x = x.view(sequence_length, -1, self.data_dimensionality)
+        batch_size = x.shape[1]
+        h_t, residuals, memories = self.network.forward_states(x, residual, memory)
+        residual = residuals[-1].unsqueeze(0)
+        memory = memories[-1]
+        residuals = residuals.view(1, sequence_length * batch_size, -1)
+        memories = memories.transpose(0, 1).reshape(memory.shape[0], sequence_length * batch_size, -1)
+        last_steps = h_t.view(sequence_length * batch_size, -1)
+        if positions is not None:
+            residuals = residuals.index_select(1, positions)
+            memories = memories.index_select(1, positions)
+            last_steps = last_steps.index_select(0, positions)
+        h = self.rollout(residuals, memories, last_steps, self.checkpoint_rollouts)
+        if is_batch and positions is None:
+            h = h.view(sequence_length, batch_size, self.forecast_length, -1)
         return h, residual, memory
 
+    # Samples `batch_size` random windows from the sequence and stacks them along the batch dimension,
+    # so that the cost of a training step doesn't depend on the length of the sequence.
+    # The first `burn_in` steps of every window only warm up the recurrent state, and aren't trained on.
+    # When training is distributed, the batch is split between the processes, rounding up.
+    def sample_windows(self, tensor: torch.Tensor):
+        window_span = self.burn_in + self.window_length + self.forecast_length + 1
+        batch_size = -(-self.batch_size // self.world_size)
+        starts = torch.randint(0, tensor.shape[0] - window_span + 1, (batch_size,)).tolist()
+        windows = torch.stack([tensor[start:start + window_span] for start in starts], dim=1)
+        residual = generate_state(self.residual_shape, batch_size)
+        memory = generate_state(self.memory_shape, batch_size)
+        if self.burn_in:
+            with torch.no_grad():
+                _, residual, memory = self.network.forward_sequence(windows[:self.burn_in], residual, memory)
+        x, y = self.segment_data(windows[self.burn_in:])
+        return x, y, residual, memory
+
     def update(self, residual: torch.Tensor, memory: torch.tensor, x: torch.Tensor):
-        h_t = None
-        for i in range(len(x)):
-            x_t = x[i].view(1, -1)
-            x_t = self.noise.add_noise(x_t)
-            h_t, residual, memory = self.network(x_t, residual, memory)
+        x = x.view(x.shape[0], -1, self.data_dimensionality)
+        x = self.noise.add_noise(x)
+        h, residual, memory = self.network.forward_sequence(x, residual, memory)
+        h_t = h[-1]
         return h_t, residual, memory
 
     def forecast_step(self, residual_t, memory_t, last_step):
-        residual_forecast = residual_t.clone()
-        memory_forecast = memory_t.clone()
-        forecast_tensor = torch.zeros(self.forecast_length, self.data_dimensionality)
-        forecast_tensor[0] = last_step
-        for i in range(1, self.forecast_length):
-            x_t = forecast_tensor[i - 1]
-            x_t = self.noise.add_noise(x_t)
-            next_step, residual_forecast, memory_forecast = self.network(x_t, residual_forecast, memory_forecast)
-            forecast_tensor[i] = next_step
+        last_step = last_step.view(-1, self.data_dimensionality)
+        noise = self.buffers.horizon_noise((self.forecast_length - 1,) + tuple(last_step.shape), self.noise)
+        forecast_tensor = self.rollout(residual_t, memory_t, last_step, noise=noise)
         return forecast_tensor
 
+    # Autoregressively forecasts `forecast_length` steps for a batch of states,
+    # `last_step` is of shape [batch, io_dimension] and the output is of shape [batch, forecast_length, io_dimension].
+    # With `checkpointed`, the activations of the rollout aren't kept for the backward pass, but recomputed during it.
+    # The `noise` of every step of the horizon is sampled if it isn't given.
+    def rollout(self, residual, memory, last_step, checkpointed: bool = False, noise: torch.Tensor = None):
+        if noise is None:
+            with record_function('sample_noise'):
+                noise = self.noise.sample((self.forecast_length - 1,) + tuple(last_step.shape))
+        if checkpointed:
+            forecast_tensor = checkpoint(self.network.rollout, last_step, residual, memory, noise, **CHECKPOINT_ARGUMENTS)
+        else:
+            forecast_tensor = self.network.rollout(last_step, residual, memory, noise)
+        return forecast_tensor
+
+    # Selects the key variables from the last dimension of `tensor`.
     def select_key_variables(self, tensor: torch.Tensor):
-        if self.key_variables:
-            filtered_tensors = []
-            if len(tensor.shape) == 3:
-                for feature in self.key_variables:
-                    index = feature['index']
-                    filtered_tensors.append(tensor[:, :, index])
-                filtered_tensor = torch.stack(filtered_tensors, dim=2)
-            else:
-                for feature in self.key_variables:
-                    index = feature['index']
-                    filtered_tensors.append(tensor[:, index])
-                filtered_tensor = torch.stack(filtered_tensors, dim=1)
+        if self.key_index is not None:
+            with record_function('select_key_variables'):
+                filtered_tensor = tensor.index_select(-1, self.key_index)
         else:
             filtered_tensor = tensor
         return filtered_tensor
 
+    # For a batch of sequences [sequence, batch, io_dimension], `y` is of shape [sequence, batch, forecast_length, io_dimension].
+    # `x` and `y` are both views of `data`, the overlapping windows of `y` share its memory rather than being copied.
     def segment_data(self, data: torch.Tensor):
-        segments = []
-        for i in range(data.shape[0] - (self.forecast_length + 1)):
-            segment = data[i + 1:i + self.forecast_length + 1]
-            segments.append(segment)
-        x = data[:-(self.forecast_length + 1)]
-        y = torch.stack(segments)
+        steps = data.shape[0] - (self.forecast_length + 1)
+        x = data[:steps]
+        y = data[1:].unfold(0, self.forecast_length, 1)[:steps].transpose(-1, -2)
         return x, y
 
 
+# Repeats every sequence of the batch dimension of `tensor` `num_samples` times in a row, like `repeat_interleave`,
+# which older versions of torch don't have.
+def repeat_samples(tensor: torch.Tensor, num_samples: int):
+    shape = tuple(tensor.shape)
+    repeated = tensor.unsqueeze(2).expand(shape[:2] + (num_samples,) + shape[2:])
+    return repeated.reshape(shape[0], shape[1] * num_samples, *shape[2:])
+
+
+# The indices of the key variables' columns, or None if every column is a key variable.
+def key_variable_index(key_variables: list):
+    if not key_variables:
+        return None
+    return torch.tensor([feature['index'] for feature in key_variables], dtype=torch.long)
+
+
+# Selects the forecasts from `positions` of the flattened [sequence * batch] steps of `y`, like `forecast_every_step`,
+# without flattening `y`, which would copy every window when it's a view from `segment_data`.
+def select_positions(y: torch.Tensor, positions: torch.Tensor):
+    if len(y.shape) == 4:
+        return y[positions // y.shape[1], positions % y.shape[1]]
+    return y.index_select(0, positions)
+
+
 def convert_to_torch_tensor(data: np.ndarray):
     return Variable(from_numpy(data)).float()
 
 
-def generate_state(shape: tuple):
-    tensor = torch.zeros(shape)
+# State shapes are stored for a batch size of 1, the batch dimension is the second one.
+def generate_state(shape: tuple, batch_size: int = 1):
+    tensor = torch.zeros(shape[0], batch_size, shape[2])
     return tensor
 
 
+# The recurrent state of a single sequence, along with the index of the last timestep it has seen,
+# in a json serializable form.
+def export_state(residual: torch.Tensor, memory: torch.Tensor, last_index: int):
+    return {'residual': residual.tolist(), 'memory': memory.tolist(), 'last_index': last_index}
+
+
+def import_state(state: dict):
+    return {'residual': torch.tensor(state['residual'], dtype=torch.float32),
+            'memory': torch.tensor(state['memory'], dtype=torch.float32),
+            'last_index': state['last_index']}
+
+
+# Intra-op threads parallelize the work within a single operation. The worker process serves many requests,
+# so a request's number of threads only applies while it's served, and the previous number is put back afterwards.
+@contextmanager
+def intra_op_threads(threads: int = None):
+    previous_threads = torch.get_num_threads()
+    if threads:
+        torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous_threads)
+
+
+# Splits the cores between `processes` training processes, each process uses its share as its intra-op threads,
+# so that they don't compete for the same cores.
+def share_intra_op_threads(processes: int):
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // processes))
+
+
+# Inter-op threads run independent operations at once. Their number can only be set once per process, before any
+# parallel work has been done, so it's a setting of the worker process rather than of a request.
+# Older versions of torch don't have inter-op threads.
+def configure_inter_op_threads(threads: int = None):
+    if not threads or not hasattr(torch, 'set_num_interop_threads') or torch.get_num_interop_threads() == threads:
+        return
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError as e:
+        print('keeping {} inter-op threads: {}'.format(str(torch.get_num_interop_threads()), str(e)))
+
+
+# Sums the gradients of every process in the distributed training group, in a single collective call.
+def all_reduce_gradients(network):
+    parameters = list(network.parameters())
+    for parameter in parameters:
+        if parameter.grad is None:
+            parameter.grad = torch.zeros_like(parameter)
+    gradients = torch.cat([parameter.grad.view(-1) for parameter in parameters])
+    dist.all_reduce(gradients)
+    offset = 0
+    for parameter in parameters:
+        parameter.grad.copy_(gradients[offset:offset + parameter.numel()].view_as(parameter.grad))
+        offset += parameter.numel()
+
+
+def all_reduce_sum(value: float):
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+# Every process takes the value of the first process's flag.
+def broadcast_flag(flag: bool):
+    tensor = torch.tensor([int(flag)])
+    dist.broadcast(tensor, 0)
+    return bool(tensor.item())
+
+
 def init_network(architecture):
     network = ForecastNetwork(architecture).float()
     return network
+
+
+# Model packages saved before a script method was added to `ForecastNetwork` don't contain it,
+# for those we copy the trained weights into a freshly built network.
+# Frozen inference networks only keep the methods used to forecast, and have no weights to copy.
+def upgrade_network(network, architecture):
+    if all(hasattr(network, method) for method in NETWORK_METHODS):
+        return network
+    if not list(network.parameters()):
+        return network
+    return restore_network(network.state_dict(), architecture)
+
+
+# Copies the weights of a saved network into a freshly built one, used when we continue training a saved model.
+def restore_network(weights: dict, architecture):
+    restored_network = init_network(architecture)
+    restored_network.load_state_dict(weights)
+    return restored_network
+
+
+# Builds a forecast only copy of a network from its weights, with the linear and recurrent layers dynamically quantized:
+# their weights are stored as int8, and activations are quantized on the fly, which speeds up inference on CPU.
+def quantize_network(weights: dict, architecture):
+    linear_in, recurrent, linear_out = build_layers(architecture)
+    layers = nn.ModuleDict({'linear_in': linear_in, 'recurrent': recurrent, 'linear_out': linear_out})
+    layers.load_state_dict(weights)
+    quantized_layers = torch.quantization.quantize_dynamic(layers, {nn.Linear, nn.GRU}, dtype=torch.qint8)
+    return ForecastNetwork(architecture, (quantized_layers['linear_in'], quantized_layers['recurrent'],
+                                          quantized_layers['linear_out']))
+
+
+# How far the forecasts of a quantized network are from those of the float network it was built from,
+# on a fixed random history, in normalized units.
+def quantization_error(network, quantized_network, meta_data: dict):
+    generator = torch.Generator().manual_seed(0)
+    history = torch.rand(QUANTIZATION_PROBE_LENGTH, 1, meta_data['io_dimension'], generator=generator)
+    noise = torch.zeros(QUANTIZATION_PROBE_LENGTH - 1, 1, meta_data['io_dimension'])
+    forecasts = []
+    with torch.no_grad():
+        for forecast_network in [network, quantized_network]:
+            residual = generate_state(meta_data['tensor_shape']['residual'])
+            memory = generate_state(meta_data['tensor_shape']['memory'])
+            h, residual, memory = forecast_network.forward_sequence(history, residual, memory)
+            forecasts.append(forecast_network.rollout(h[-1], residual, memory, noise))
+    delta = (forecasts[1] - forecasts[0]).abs()
+    return {'mean_absolute_delta': delta.mean().item(), 'max_absolute_delta': delta.max().item()}
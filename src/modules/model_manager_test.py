@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import torch
+from src.OpenForecast import Parameters
+from src.modules import data_utilities, model_manager
+
+TOLERANCE = 1e-6
+
+
+# A model without noise, so that its forecasts are deterministic. A complexity of 0.1 builds a single layer recurrent
+# module, higher ones build deeper modules, which `forward_states` steps through one timestep at a time.
+def build_test_model(complexity, sequence_length=30, key_variables=None):
+    torch.manual_seed(0)
+    parameters = Parameters()
+    parameters.mode = 'train'
+    parameters.forecast_length = 4
+    parameters.model_complexity = complexity
+    parameters.io_noise = 0
+    data = {'tensor': np.random.RandomState(0).rand(sequence_length, 3).tolist(), 'key_variables': key_variables}
+    tensor, meta_data = data_utilities.process_input(data, parameters)
+    return model_manager.Model(meta_data), tensor
+
+
+# The forecasts from every timestep, rolled out one timestep at a time with `forward`.
+def step_by_step_forecasts(model, x):
+    residual = model_manager.generate_state(model.residual_shape)
+    memory = model_manager.generate_state(model.memory_shape)
+    forecasts = []
+    for t in range(x.shape[0]):
+        h_t, residual, memory = model.network.forward(x[t], residual, memory)
+        step_residual, step_memory = residual, memory
+        steps = [h_t[0]]
+        for _ in range(model.forecast_length - 1):
+            next_step, step_residual, step_memory = model.network.forward(steps[-1], step_residual, step_memory)
+            steps.append(next_step[0])
+        forecasts.append(torch.stack(steps, 1)[0])
+    return torch.stack(forecasts)
+
+
+def gradients(model):
+    return [parameter.grad.clone() for parameter in model.network.parameters()]
+
+
+def test_forward_sequence():
+    for complexity in [0.1, 0.5]:
+        model, tensor = build_test_model(complexity)
+        x = model_manager.convert_to_torch_tensor(tensor).view(tensor.shape[0], 1, -1)
+        residual = model_manager.generate_state(model.residual_shape)
+        memory = model_manager.generate_state(model.memory_shape)
+        h, sequence_residual, sequence_memory = model.network.forward_sequence(x, residual, memory)
+        for t in range(x.shape[0]):
+            h_t, residual, memory = model.network.forward(x[t], residual, memory)
+            assert torch.allclose(h[t], h_t[0], atol=TOLERANCE)
+        assert torch.allclose(sequence_residual, residual, atol=TOLERANCE)
+        assert torch.allclose(sequence_memory, memory, atol=TOLERANCE)
+
+
+def test_rollout():
+    model, tensor = build_test_model(0.5)
+    x = model_manager.convert_to_torch_tensor(tensor)
+    residual = model_manager.generate_state(model.residual_shape)
+    memory = model_manager.generate_state(model.memory_shape)
+    noise = torch.zeros(model.forecast_length - 1, 1, model.data_dimensionality)
+    rolled_out = model.network.rollout(x[:1], residual, memory, noise)
+    steps = [x[:1]]
+    for _ in range(model.forecast_length - 1):
+        next_step, residual, memory = model.network.forward(steps[-1], residual, memory)
+        steps.append(next_step[0])
+
+    assert torch.allclose(rolled_out, torch.stack(steps, 1), atol=TOLERANCE)
+
+
+def test_forecast_every_step():
+    for complexity in [0.1, 0.5]:
+        model, tensor = build_test_model(complexity)
+        x, y = model.segment_data(model_manager.convert_to_torch_tensor(tensor))
+        criterion = torch.nn.MSELoss()
+        expected = step_by_step_forecasts(model, x)
+        criterion(expected, y).backward()
+        expected_gradients = gradients(model)
+        model.network.zero_grad()
+        h, _, _ = model.forecast_every_step(model_manager.generate_state(model.residual_shape),
+                                            model_manager.generate_state(model.memory_shape), x)
+        criterion(h, y).backward()
+
+        assert torch.allclose(h, expected, atol=TOLERANCE)
+        for gradient, expected_gradient in zip(gradients(model), expected_gradients):
+            assert torch.allclose(gradient, expected_gradient, atol=TOLERANCE)
+
+
+def test_segment_data():
+    model, tensor = build_test_model(0.1, key_variables=[{'index': 2}, {'index': 0}])
+    for data in [torch.rand(20, 3), torch.rand(20, 5, 3)]:
+        x, y = model.segment_data(data)
+        steps = data.shape[0] - (model.forecast_length + 1)
+        expected = torch.stack([data[i + 1:i + model.forecast_length + 1] for i in range(steps)])
+        if len(data.shape) == 3:
+            expected = expected.transpose(1, 2)
+
+        assert torch.equal(x, data[:steps])
+        assert torch.equal(y, expected)
+        assert y.data_ptr() == data[1].data_ptr()
+        assert torch.equal(model.select_key_variables(y), torch.stack([expected[..., 2], expected[..., 0]], dim=-1))
+
+
+def test_incremental_forecast():
+    model, tensor = build_test_model(0.5)
+    expected = model.forecast(tensor)
+    _, residual, memory = model.forecast_with_state(tensor[:20])
+    state = model_manager.import_state(model_manager.export_state(residual, memory, 19))
+    forecast = model.forecast(tensor[20:], [state])
+
+    assert np.allclose(forecast, expected, atol=TOLERANCE)
+
+
+def test_checkpointed_rollouts():
+    model, tensor = build_test_model(0.5)
+    x, y = model.segment_data(model_manager.convert_to_torch_tensor(tensor))
+    criterion = torch.nn.MSELoss()
+    model.backpropagate(model_manager.generate_state(model.residual_shape),
+                        model_manager.generate_state(model.memory_shape), x, y, criterion)
+    expected_gradients = gradients(model)
+    model.network.zero_grad()
+    model.checkpoint_rollouts = True
+    model.backpropagate(model_manager.generate_state(model.residual_shape),
+                        model_manager.generate_state(model.memory_shape), x, y, criterion)
+
+    for gradient, expected_gradient in zip(gradients(model), expected_gradients):
+        assert torch.allclose(gradient, expected_gradient, atol=TOLERANCE)
+
+
+def test_repeat_samples():
+    tensor = torch.rand(5, 3, 2)
+
+    assert torch.equal(model_manager.repeat_samples(tensor, 4), torch.cat([tensor[:, b:b + 1].expand(5, 4, 2)
+                                                                           for b in range(3)], dim=1))
+
+
+def test_intra_op_threads():
+    threads = torch.get_num_threads()
+    with model_manager.intra_op_threads(1):
+        assert torch.get_num_threads() == 1
+
+    assert torch.get_num_threads() == threads
+
+
+def test_share_intra_op_threads():
+    threads = torch.get_num_threads()
+    try:
+        model_manager.share_intra_op_threads(os.cpu_count() * 2)
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
@@ -0,0 +1,94 @@
+import io
+import os
+from copy import deepcopy
+from math import ceil, log2
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from src.modules import data_utilities, model_manager
+
+# The normalized training data, shared with every process of the pool rather than copied into each task.
+shared_tensor = None
+
+
+def sweep(meta_data: dict, data: np.ndarray, candidates: list, training_time: float):
+    r"""
+    Trains a model for every (model_complexity, io_noise) pair in `candidates` on the same data,
+    and picks the best one by successive halving.
+
+    The `training_time` budget is split evenly into rounds, in every round the remaining candidates are trained
+    concurrently on a pool of processes, each continuing from where it left off in the previous round.
+    After every round, the worse half of the candidates are dropped, until one is left.
+
+    Returns the winning model, its meta_data object and error, along with a leaderboard of every candidate,
+    those that lasted the most rounds first, then sorted by error.
+    """
+    entries = []
+    for complexity, io_noise in candidates:
+        candidate_meta_data = data_utilities.update_model_meta_data(deepcopy(meta_data), complexity, io_noise)
+        entries.append({'meta_data': candidate_meta_data, 'package': None, 'final_error': None, 'rounds': 0})
+    processes = max(1, min(len(entries), os.cpu_count() or 1))
+    rounds = max(1, ceil(log2(len(entries))))
+    round_time = training_time / rounds
+    tensor = torch.from_numpy(data).share_memory_()
+    context = mp.get_context('spawn')
+    remaining = entries
+    with context.Pool(processes, initializer=init_worker, initargs=(tensor, processes)) as pool:
+        for sweep_round in range(rounds):
+            candidate_time = round_time / ceil(len(remaining) / processes)
+            print('sweep round {}: training {} candidates for {}s each'
+                  .format(str(sweep_round), str(len(remaining)), str(candidate_time)))
+            tasks = [(entry['meta_data'], entry['package'], candidate_time) for entry in remaining]
+            for entry, (error, package) in zip(remaining, pool.starmap(train_candidate, tasks)):
+                entry['final_error'] = error
+                entry['package'] = package
+                entry['rounds'] += 1
+            remaining = sorted(remaining, key=sort_key)[:max(1, ceil(len(remaining) / 2))]
+    winner = remaining[0]
+    winner['meta_data']['training_time'] = training_time
+    weights, optimizer_state = unpack(winner['package'])
+    model = model_manager.Model(winner['meta_data'], optimizer_state=optimizer_state)
+    model.network.load_state_dict(weights)
+    leaderboard = [{'model_complexity': entry['meta_data']['complexity'], 'io_noise': entry['meta_data']['io_noise'],
+                    'final_error': entry['final_error'], 'rounds': entry['rounds']}
+                   for entry in sorted(entries, key=lambda entry: (-entry['rounds'], sort_key(entry)))]
+    return model, winner['meta_data'], winner['final_error'], leaderboard
+
+
+# Candidates that didn't manage a single training step have no error, and sort last.
+def sort_key(entry: dict):
+    if entry['final_error'] is None:
+        return float('inf')
+    return entry['final_error']
+
+
+def init_worker(tensor: torch.Tensor, processes: int):
+    global shared_tensor
+    shared_tensor = tensor
+    model_manager.share_intra_op_threads(processes)
+
+
+# Trains a candidate for `training_time` seconds, starting from its packed weights and optimizer state if it has any.
+def train_candidate(meta_data: dict, package: bytes, training_time: float):
+    meta_data = dict(meta_data, training_time=training_time)
+    if package:
+        weights, optimizer_state = unpack(package)
+        model = model_manager.Model(meta_data, optimizer_state=optimizer_state)
+        model.network.load_state_dict(weights)
+    else:
+        model = model_manager.Model(meta_data)
+    error = model.train_model(shared_tensor.numpy())
+    return error, pack(model.network.state_dict(), model.extract_optimizer_state())
+
+
+# Weights are passed between processes as bytes, so they don't depend on the sending process staying alive.
+def pack(weights: dict, optimizer_state: dict):
+    buffer = io.BytesIO()
+    torch.save({'network': weights, 'optimizer': optimizer_state}, buffer)
+    return buffer.getvalue()
+
+
+def unpack(package: bytes):
+    contents = torch.load(io.BytesIO(package))
+    return contents['network'], contents['optimizer']
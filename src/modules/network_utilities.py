@@ -1,17 +1,33 @@
 import Algorithmia
-from time import sleep
-from requests.exceptions import ConnectionError
 import torch
+import numpy as np
 import zipfile
+import io
 import json
 import os
+import shutil
+import tempfile
 from src.modules.forecast_model import ForecastNetwork
+from src.modules import profiling
+from src.modules.data_store import AlgorithmiaStore, FileCache
 from uuid import uuid4
 
 client = Algorithmia.client()
 
 MODEL_FILE_NAME = 'model_architecture.pb'
+INFERENCE_MODEL_FILE_NAME = 'inference_model.pb'
 META_DATA_FILE_NAME = 'meta_data.json'
+STATE_FILE_NAME = 'state.json'
+OPTIMIZER_FILE_NAME = 'optimizer_state.pt'
+SIDECAR_SUFFIX = '.meta.json'
+DATA_CACHE_DIRECTORY = '/tmp/openforecast_cache'
+DATA_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+PACKAGE_VERSION = 2
+# The methods of the network used to forecast, which are kept when freezing it into an inference graph.
+INFERENCE_METHODS = ['forward_sequence', 'rollout']
+
+store = AlgorithmiaStore(client)
+data_cache = FileCache(DATA_CACHE_DIRECTORY, DATA_CACHE_MAX_BYTES)
 
 
 class AlgorithmError(Exception):
@@ -27,45 +43,120 @@ def get_model_package(remote_package_path: str):
     - The serialized torch graph representing the network called 'model_architecture.pb'
     - A meta data file containing other information such as architecture and information around training, called 'meta_data.json'
 
+    Since version 2 of the package format (the 'package_version' field of the meta data), packages also contain:
+    - A frozen graph optimized for inference called 'inference_model.pb', which is what gets returned when present.
+    It can only forecast, and has no parameters to train, see `get_package_weights` for those.
     """
 
+    local_file_path = get_package_file(remote_package_path)
+    return load_model_package(local_file_path)
+
+# Model packages can optionally contain the recurrent state at the end of their training data, called 'state.json'.
+# Returns None if the package doesn't have one.
+def get_package_state(remote_package_path: str):
+    local_file_path = get_package_file(remote_package_path)
+    archive = zipfile.ZipFile(local_file_path, 'r')
+    if STATE_FILE_NAME not in archive.namelist():
+        return None
+    return json.loads(archive.read(STATE_FILE_NAME).decode('utf-8'))
+
+# Model packages also contain the optimizer state at the end of training, called 'optimizer_state.pt',
+# so that training can be resumed. Returns None for packages saved without one.
+def get_package_optimizer_state(remote_package_path: str):
+    local_file_path = get_package_file(remote_package_path)
+    archive = zipfile.ZipFile(local_file_path, 'r')
+    if OPTIMIZER_FILE_NAME not in archive.namelist():
+        return None
+    return torch.load(io.BytesIO(archive.read(OPTIMIZER_FILE_NAME)))
+
+# The weights of the network in a package, used to continue training from it, or to quantize it.
+# They're read from 'model_architecture.pb', as the frozen inference graph has no parameters.
+def get_package_weights(remote_package_path: str):
+    local_file_path = get_package_file(remote_package_path)
+    meta_data = load_package_meta_data(local_file_path)
+    model_file, _ = unzip(local_file_path)
+    return torch.jit.load(model_file).state_dict(), meta_data
+
+def get_state(remote_path: str):
+    return load_json(get_data(remote_path))
+
+def put_state(state: dict, remote_path: str):
+    local_file_path = save_json(state, "{}.json".format(str(uuid4())))
+    return put_file(local_file_path, remote_path)
+
+def get_package_file(remote_package_path: str):
     if remote_package_path.startswith('file://'):
         local_file_path = "".join(remote_package_path.split('file:/')[1:])
     else:
         local_file_path = get_data(remote_package_path)
-    model_file, meta_data_file = unzip(local_file_path)
-    model = torch.jit.load(model_file)
-    meta_data = json.loads(meta_data_file.read().decode('utf-8'))
+    return local_file_path
+
+def load_model_package(local_file_path: str):
+    archive = zipfile.ZipFile(local_file_path, 'r')
+    if INFERENCE_MODEL_FILE_NAME in archive.namelist():
+        model = torch.jit.load(io.BytesIO(archive.read(INFERENCE_MODEL_FILE_NAME)))
+    else:
+        model = torch.jit.load(archive.open(MODEL_FILE_NAME))
+    meta_data = json.loads(archive.read(META_DATA_FILE_NAME).decode('utf-8'))
     return model, meta_data
 
-def save_model_package(network: ForecastNetwork, meta_data: dict, remote_file_path: str):
-    file_paths = list()
-    file_paths.append(save_model(network))
-    file_paths.append(save_metadata(meta_data))
-    local_zip_arch = zip(file_paths)
+def load_package_meta_data(local_file_path: str):
+    archive = zipfile.ZipFile(local_file_path, 'r')
+    return json.loads(archive.read(META_DATA_FILE_NAME).decode('utf-8'))
+
+def save_model_package(network: ForecastNetwork, meta_data: dict, remote_file_path: str, state: dict = None,
+                       optimizer_state: dict = None):
+    # Every package is staged in its own directory, so packages saved concurrently never overwrite each other's files.
+    directory = tempfile.mkdtemp()
+    try:
+        file_paths = list()
+        file_paths.append(save_model(network, directory))
+        inference_path = save_inference_model(network, directory)
+        if inference_path:
+            file_paths.append(inference_path)
+        meta_data = dict(meta_data, package_version=PACKAGE_VERSION, weights_bytes=weights_bytes(network))
+        file_paths.append(save_metadata(meta_data, directory))
+        if state:
+            file_paths.append(save_json(state, STATE_FILE_NAME, directory))
+        if optimizer_state:
+            file_paths.append(save_optimizer_state(optimizer_state, directory))
+        local_zip_arch = zip(file_paths)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
     output = put_file(local_zip_arch, remote_file_path)
     return output
 
 def put_file(local_path: str, remote_path: str):
-    if remote_path.startswith('file://'):
-        output_path= put_file_locally(local_path, remote_path)
-    else:
-        output_path = put_file_remote(local_path, remote_path)
+    with profiling.phase('upload'):
+        if remote_path.startswith('file://'):
+            output_path= put_file_locally(local_path, remote_path)
+        else:
+            output_path = put_file_remote(local_path, remote_path)
     return output_path
 
 def get_data(file_path: str):
+    with profiling.phase('download'):
+        if file_path.startswith('file://'):
+            output_path = get_file_locally(file_path)
+        else:
+            output_path = get_data_remote(file_path)
+    return output_path
+
+def file_exists(file_path: str):
     if file_path.startswith('file://'):
-        output_path = get_file_locally(file_path)
+        return os.path.isfile(get_file_locally(file_path))
     else:
-        output_path = get_data_remote(file_path)
-    return output_path
+        return store.exists(file_path)
 
+# Remote files are served from the on-disk cache whenever the remote store reports they haven't changed,
+# the returned file is shared with future requests and must not be modified.
 def get_data_remote(remote_file_path: str):
-    try:
-        result = client.file(remote_file_path).getFile().name
-    except ConnectionError:
-        result = get_data_remote(remote_file_path)
-    return result
+    return data_cache.get(store, remote_file_path)
+
+# Replaces the remote store, for example with a `data_store.LocalStore` to work without access to the data API.
+def set_data_store(data_store):
+    global store
+    store = data_store
 
 def get_file_locally(local_path: str):
     regular_path = "".join(local_path.split('file:/')[1:])
@@ -77,12 +168,7 @@ def put_file_locally(local_path: str, final_local_path: str):
     return regular_path
 
 def put_file_remote(local_path: str, remote_path: str):
-    try:
-        client.file(remote_path).putFile(local_path)
-    except ConnectionError:
-        sleep(5)
-        return put_file_remote(local_path, remote_path)
-    return remote_path
+    return store.put(local_path, remote_path)
 
 
 def unzip(local_path: str):
@@ -102,15 +188,51 @@ def zip(file_paths: list):
 
 
 
-def save_model(model: ForecastNetwork):
-    local_file_path = "/tmp/{}".format(MODEL_FILE_NAME)
+def save_model(model: ForecastNetwork, directory: str):
+    local_file_path = os.path.join(directory, MODEL_FILE_NAME)
     print(model.graph)
     model.save(local_file_path)
     return local_file_path
 
 
-def save_metadata(data: dict):
-    local_file_path = "/tmp/{}".format(META_DATA_FILE_NAME)
+# The size of the network's weights, recorded in the meta data as the frozen inference graph has no parameters.
+def weights_bytes(network: ForecastNetwork):
+    return sum(tensor.numel() * tensor.element_size() for tensor in network.state_dict().values())
+
+
+# Freezing inlines the weights into the graph as constants, which lets torch fold and fuse operations for inference.
+# Older versions of torch can't freeze a network, in which case the package is saved without an inference graph.
+def save_inference_model(network: ForecastNetwork, directory: str):
+    if not hasattr(torch.jit, 'freeze'):
+        return None
+    local_file_path = os.path.join(directory, INFERENCE_MODEL_FILE_NAME)
+    training = network.training
+    try:
+        network.eval()
+        frozen_network = torch.jit.freeze(network, preserved_attrs=INFERENCE_METHODS)
+        if hasattr(torch.jit, 'optimize_for_inference'):
+            frozen_network = torch.jit.optimize_for_inference(frozen_network, other_methods=INFERENCE_METHODS)
+        frozen_network.save(local_file_path)
+    except (RuntimeError, TypeError) as e:
+        print('saving the model package without an inference graph: {}'.format(str(e)))
+        return None
+    finally:
+        network.train(training)
+    return local_file_path
+
+
+def save_optimizer_state(optimizer_state: dict, directory: str):
+    local_file_path = os.path.join(directory, OPTIMIZER_FILE_NAME)
+    torch.save(optimizer_state, local_file_path)
+    return local_file_path
+
+
+def save_metadata(data: dict, directory: str):
+    return save_json(data, META_DATA_FILE_NAME, directory)
+
+
+def save_json(data: dict, file_name: str, directory: str = '/tmp'):
+    local_file_path = os.path.join(directory, file_name)
     with open(local_file_path, 'w') as f:
         json.dump(data, f)
     return local_file_path
@@ -118,4 +240,36 @@ def save_metadata(data: dict):
 def load_json(file_path: str):
     with open(file_path, 'r') as f:
         data = json.load(f)
+    return data
+
+
+def load_dataset(file_path: str):
+    r"""
+    Datasets can be provided in one of three formats, chosen by the file extension:
+    - `.json` - the standard timeseries format, a json object with a 'tensor' and optionally 'key_variables'.
+    - `.npy` - a numpy array file containing the tensor, which is memory mapped rather than read into memory.
+    The key variables live in a json sidecar file next to it, where `data.npy` has a sidecar called `data.meta.json`.
+    - `.npz` - a numpy archive containing a 'tensor' array, and optionally a 'key_variables' json string.
+    """
+
+    with profiling.phase('load_dataset'):
+        return read_dataset(file_path)
+
+
+def read_dataset(file_path: str):
+    local_path = get_data(file_path)
+    if file_path.endswith('.npy'):
+        data = {'tensor': np.load(local_path, mmap_mode='r')}
+        sidecar_path = file_path[:-len('.npy')] + SIDECAR_SUFFIX
+        if file_exists(sidecar_path):
+            sidecar = load_json(get_data(sidecar_path))
+            if 'key_variables' in sidecar:
+                data['key_variables'] = sidecar['key_variables']
+    elif file_path.endswith('.npz'):
+        archive = np.load(local_path)
+        data = {'tensor': archive['tensor']}
+        if 'key_variables' in archive.files:
+            data['key_variables'] = json.loads(str(archive['key_variables']))
+    else:
+        data = load_json(local_path)
     return data
\ No newline at end of file
@@ -0,0 +1,53 @@
+import json
+import torch
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from src.modules import model_manager, network_utilities
+from src.modules.model_cache_test import save_test_package
+
+
+def test_package_weights():
+    path = "file://tmp/network_utilities_test_0.zip"
+    save_test_package(path)
+    weights, meta_data = network_utilities.get_package_weights(path)
+    network, _ = network_utilities.get_model_package(path)
+
+    assert meta_data['package_version'] == network_utilities.PACKAGE_VERSION
+    restored_network = model_manager.restore_network(weights, meta_data['architecture'])
+    for name, tensor in restored_network.state_dict().items():
+        assert torch.equal(tensor, weights[name])
+    assert hasattr(network, 'rollout')
+
+
+def test_version_1_package():
+    path = "file://tmp/network_utilities_test_1.zip"
+    archive = zipfile.ZipFile(save_test_package(path), 'r')
+    meta_data = json.loads(archive.read(network_utilities.META_DATA_FILE_NAME).decode('utf-8'))
+    del meta_data['package_version'], meta_data['weights_bytes']
+    legacy_path = "/tmp/network_utilities_test_legacy.zip"
+    legacy_archive = zipfile.ZipFile(legacy_path, 'w')
+    legacy_archive.writestr(network_utilities.MODEL_FILE_NAME, archive.read(network_utilities.MODEL_FILE_NAME))
+    legacy_archive.writestr(network_utilities.META_DATA_FILE_NAME, json.dumps(meta_data))
+    legacy_archive.close()
+    weights, _ = network_utilities.get_package_weights("file:/" + legacy_path)
+    network, _ = network_utilities.get_model_package("file:/" + legacy_path)
+
+    assert set(weights.keys()) == set(network.state_dict().keys())
+
+
+def test_concurrent_package_saves():
+    paths = ["file://tmp/network_utilities_test_concurrent_{}.zip".format(str(i)) for i in range(4)]
+    with ThreadPoolExecutor(len(paths)) as executor:
+        list(executor.map(save_test_package, paths))
+
+    for path in paths:
+        network, meta_data = network_utilities.get_model_package(path)
+        archive = zipfile.ZipFile(network_utilities.get_package_file(path), 'r')
+        trainable_network = torch.jit.load(archive.open(network_utilities.MODEL_FILE_NAME))
+        x = torch.rand(10, 1, meta_data['io_dimension'])
+        residual = model_manager.generate_state(meta_data['tensor_shape']['residual'])
+        memory = model_manager.generate_state(meta_data['tensor_shape']['memory'])
+
+        assert meta_data['weights_bytes'] == network_utilities.weights_bytes(trainable_network)
+        assert torch.allclose(network.forward_sequence(x, residual, memory)[0],
+                              trainable_network.forward_sequence(x, residual, memory)[0], atol=1e-6)
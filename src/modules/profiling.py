@@ -0,0 +1,263 @@
+import json
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+import torch
+
+# The profiler of the request being served, phases are only recorded while one is active.
+active_profiler = None
+# The number of operators listed in the summary of a torch profile.
+SUMMARY_ROWS = 25
+# Torch profiles need `torch.profiler`, from torch 1.8.1.
+TORCH_PROFILES_SUPPORTED = hasattr(torch, 'profiler')
+
+
+class Profiler:
+    r"""
+    Records the resources used by every phase of serving a request, a phase being any block of code wrapped in `phase()`.
+
+    For every phase we record the number of times it ran, and in total:
+    - `wall_time` - the elapsed time in seconds.
+    - `cpu_time` - the CPU time of the whole process in seconds, including every thread torch computes on.
+    - `peak_traced_bytes` - the most memory python and numpy had allocated at once during the phase,
+    over what was allocated when it started, as traced by `tracemalloc`.
+    - `max_rss_bytes` - the peak resident memory of the process so far, which includes torch's allocations.
+
+    Phases can be nested, in which case the outer phase includes the inner one.
+    Memory peaks are approximate when phases run concurrently on many threads, as `tracemalloc` only has one peak.
+
+    With `torch_profile_steps`, the first that many training steps, and the forecasts, are also recorded by the torch
+    profiler, see `TorchProfile`. Phases are only recorded when `timings` is set. Tracing is paused while a torch
+    profile is summarized, as tracing every allocation of the summary slows it down by orders of magnitude,
+    memory allocated before the pause isn't counted by the phases that are still open.
+    """
+
+    def __init__(self, timings: bool = True, torch_profile_steps: int = None):
+        self.timings = timings
+        self.torch_profile_steps = torch_profile_steps
+        self.torch_profiles = dict()
+        self.phases = dict()
+        self.values = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stacks = []
+        self.started_tracing = False
+
+    def start(self):
+        if not self.timings:
+            return
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    # Stops tracing for the duration of the block, if this profiler is the one tracing. The phases still open are
+    # measured from where tracing restarts, as the memory traced until then is forgotten.
+    @contextmanager
+    def paused_tracing(self):
+        if not self.started_tracing:
+            yield
+            return
+        traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+        for frame in self.stack():
+            frame['peak_traced_bytes'] = max(frame['peak_traced_bytes'], peak_traced_bytes)
+        tracemalloc.stop()
+        try:
+            yield
+        finally:
+            tracemalloc.start()
+            with self.lock:
+                for stack in self.stacks:
+                    for frame in stack:
+                        frame['traced_bytes'] -= traced_bytes
+                        frame['peak_traced_bytes'] -= traced_bytes
+
+    @contextmanager
+    def phase(self, name: str):
+        stack = self.stack()
+        traced_bytes, _ = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        # Every open phase tracks the highest peak of the phases nested in it, since they reset the peak.
+        frame = {'traced_bytes': traced_bytes, 'peak_traced_bytes': traced_bytes}
+        stack.append(frame)
+        wall_start = perf_counter()
+        cpu_start = process_time()
+        try:
+            yield
+        finally:
+            wall_time = perf_counter() - wall_start
+            cpu_time = process_time() - cpu_start
+            _, peak_traced_bytes = tracemalloc.get_traced_memory()
+            stack.pop()
+            peak_traced_bytes = max(peak_traced_bytes, frame['peak_traced_bytes'])
+            if stack:
+                stack[-1]['peak_traced_bytes'] = max(stack[-1]['peak_traced_bytes'], peak_traced_bytes)
+            with self.lock:
+                entry = self.phases.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                                      'peak_traced_bytes': 0, 'max_rss_bytes': 0})
+                entry['calls'] += 1
+                entry['wall_time'] += wall_time
+                entry['cpu_time'] += cpu_time
+                entry['peak_traced_bytes'] = max(entry['peak_traced_bytes'], peak_traced_bytes - frame['traced_bytes'])
+                entry['max_rss_bytes'] = max_rss_bytes()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+            with self.lock:
+                self.stacks.append(self.local.stack)
+        return self.local.stack
+
+    def record(self, name: str, values: dict):
+        with self.lock:
+            self.values[name] = values
+
+    def report(self):
+        with self.lock:
+            report = {'phases': {name: dict(entry) for name, entry in self.phases.items()}}
+            report.update(self.values)
+        return report
+
+
+class TorchProfile:
+    r"""
+    Records every torch operator run between `start()` and `stop()` with the torch profiler, along with the
+    blocks of code labelled with `torch.autograd.profiler.record_function`, such as the steps of a training iteration.
+
+    Once stopped, the profile is summarized as a table of the operators that took the most CPU time. It can also be
+    exported as a Chrome trace with `export_trace`, which can be opened in `chrome://tracing` to see the operators
+    on a timeline.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.running = False
+        self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True)
+
+    def start(self):
+        self.profiler.__enter__()
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return None
+        self.profiler.__exit__(None, None, None)
+        self.running = False
+        return self.summarize()
+
+    def summarize(self):
+        events = sorted(self.profiler.key_averages(), key=lambda event: event.self_cpu_time_total, reverse=True)
+        operators = [{'name': event.key,
+                      'calls': event.count,
+                      'self_cpu_time_us': event.self_cpu_time_total,
+                      'cpu_time_us': event.cpu_time_total} for event in events[:SUMMARY_ROWS]]
+        table = self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=SUMMARY_ROWS)
+        return {'operators': operators, 'table': table}
+
+    def export_trace(self, path: str):
+        self.profiler.export_chrome_trace(path)
+
+
+# Labels a block of code in torch profiles. Older versions of torch can't label blocks of code, which are then left
+# unlabelled, the rest of the algorithm runs as it would otherwise.
+if hasattr(torch.autograd.profiler, 'record_function'):
+    record_function = torch.autograd.profiler.record_function
+else:
+    @contextmanager
+    def record_function(name: str):
+        yield
+
+
+# Linux reports the peak resident memory in kilobytes.
+def max_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Makes a new profiler the active one for the duration of a request, yields None if profiling isn't `enabled`,
+# and there are no `torch_profile_steps`.
+@contextmanager
+def profile(enabled: bool = True, torch_profile_steps: int = None):
+    global active_profiler
+    if not enabled and not torch_profile_steps:
+        yield None
+        return
+    profiler = Profiler(enabled, torch_profile_steps)
+    previous_profiler = active_profiler
+    active_profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        active_profiler = previous_profiler
+
+
+# Records a phase of the active profiler, does nothing if there isn't one.
+@contextmanager
+def phase(name: str):
+    profiler = active_profiler
+    if profiler is None or not profiler.timings:
+        yield
+        return
+    with profiler.phase(name):
+        yield
+
+
+# Records values that aren't tied to a phase with the active profiler, such as training throughput.
+def record(name: str, values: dict):
+    if active_profiler is not None:
+        active_profiler.record(name, values)
+
+
+# The number of training steps to record with the torch profiler, None if they shouldn't be.
+def torch_profile_steps():
+    if active_profiler is None:
+        return None
+    return active_profiler.torch_profile_steps
+
+
+# Starts recording a torch profile called `name`, if the active profiler asks for them. Returns None if it doesn't,
+# once stopped with `stop_torch_profile` its summary is kept by the active profiler.
+def start_torch_profile(name: str):
+    if not torch_profile_steps() or not TORCH_PROFILES_SUPPORTED:
+        return None
+    torch_profile = TorchProfile(name)
+    torch_profile.start()
+    return torch_profile
+
+
+# Once stopped, the active profiler keeps the summary of the torch profile, and the profile itself to export its trace.
+def stop_torch_profile(torch_profile: TorchProfile):
+    if torch_profile is None or not torch_profile.running:
+        return
+    profiler = active_profiler
+    if profiler is None:
+        torch_profile.stop()
+        return
+    with profiler.paused_tracing():
+        summary = torch_profile.stop()
+    summary['profile'] = torch_profile
+    with profiler.lock:
+        profiler.torch_profiles[torch_profile.name] = summary
+
+
+@contextmanager
+def torch_profile(name: str):
+    recording = start_torch_profile(name)
+    try:
+        yield
+    finally:
+        stop_torch_profile(recording)
+
+
+# Writes a report as a single json line, so it can be picked up from the algorithm's logs.
+def log_report(report: dict):
+    print(json.dumps({'timings': report}))
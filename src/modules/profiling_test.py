@@ -0,0 +1,43 @@
+import tracemalloc
+from src.modules import profiling
+
+
+def test_phases():
+    with profiling.profile() as profiler:
+        with profiling.phase('outer'):
+            with profiling.phase('inner'):
+                data = [0] * 100000
+            del data
+        with profiling.phase('inner'):
+            pass
+        profiling.record('training', {'steps': 1})
+    report = profiler.report()
+
+    assert report['phases']['inner']['calls'] == 2
+    assert report['phases']['outer']['calls'] == 1
+    assert report['phases']['outer']['wall_time'] > 0
+    assert report['phases']['outer']['peak_traced_bytes'] >= 100000
+    assert report['training'] == {'steps': 1}
+
+
+def test_disabled():
+    with profiling.profile(False) as profiler:
+        with profiling.phase('phase'):
+            pass
+
+    assert profiler is None
+    assert profiling.active_profiler is None
+
+
+def test_paused_tracing():
+    with profiling.profile() as profiler:
+        with profiling.phase('outer'):
+            data = [0] * 100000
+            with profiler.paused_tracing():
+                assert not tracemalloc.is_tracing()
+            assert tracemalloc.is_tracing()
+            del data
+    report = profiler.report()
+
+    assert report['phases']['outer']['calls'] == 1
+    assert report['phases']['outer']['peak_traced_bytes'] >= 100000
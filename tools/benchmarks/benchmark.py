@@ -0,0 +1,189 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import torch
+from src.OpenForecast import Parameters
+from src.modules import data_utilities, model_manager, network_utilities
+
+WARMUP = 3
+# Every sample times as many calls as it takes to run for at least this long, so that microbenchmarks aren't
+# dominated by the resolution of the timer and the noise of a single call.
+MIN_SAMPLE_TIME = 0.05
+
+
+def synthetic_series(sequence_length, io_dimension, seed):
+    r"""
+    Every variable is the sum of two sine waves with random periods and phases, a linear trend and gaussian noise,
+    so the series are deterministic for a given seed, and look enough like real data to exercise every code path.
+    """
+
+    generator = np.random.RandomState(seed)
+    t = np.arange(sequence_length, dtype=np.float64)[:, None]
+    periods = generator.uniform(5, 100, size=(2, io_dimension))
+    phases = generator.uniform(0, 2 * np.pi, size=(2, io_dimension))
+    series = np.sin(2 * np.pi * t / periods[0] + phases[0]) + 0.5 * np.sin(2 * np.pi * t / periods[1] + phases[1])
+    series += generator.uniform(-1, 1, size=io_dimension) * t / sequence_length
+    series += generator.normal(0, 0.1, size=series.shape)
+    return {'tensor': series.astype(np.float32)}
+
+
+# The number of calls timed by every sample, doubled until they take at least `MIN_SAMPLE_TIME`.
+def calibrate(function):
+    iterations = 1
+    while True:
+        start = perf_counter()
+        for _ in range(iterations):
+            function()
+        if perf_counter() - start >= MIN_SAMPLE_TIME:
+            return iterations
+        iterations *= 2
+
+
+# Times of a single call, averaged over the calls of every sample. The garbage collector is paused while timing,
+# like `timeit` does, so a collection triggered by earlier benchmarks doesn't land in a random sample.
+def measure(function, repeats):
+    for _ in range(WARMUP):
+        function()
+    iterations = calibrate(function)
+    times = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = perf_counter()
+            for _ in range(iterations):
+                function()
+            times.append((perf_counter() - start) / iterations)
+    finally:
+        gc.enable()
+    times = np.asarray(times)
+    return {'median': float(np.median(times)),
+            'mean': float(np.mean(times)),
+            'min': float(np.min(times)),
+            'p90': float(np.percentile(times, 90)),
+            'repeats': repeats,
+            'iterations': iterations,
+            'unit': 'seconds'}
+
+
+def run_benchmarks(args):
+    torch.set_num_threads(args.threads)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    parameters = Parameters()
+    parameters.mode = 'train'
+    parameters.forecast_length = args.forecast_length
+    parameters.model_complexity = args.model_complexity
+    data = synthetic_series(args.sequence_length, args.io_dimension, args.seed)
+    tensor, meta_data = data_utilities.process_input(data, parameters)
+    model = model_manager.Model(meta_data)
+    results = dict()
+
+    results['preprocessing'] = measure(lambda: data_utilities.process_input(data, parameters, dict(meta_data)),
+                                       args.repeats)
+    results['preprocessing']['rows_per_second'] = args.sequence_length / results['preprocessing']['median']
+
+    step = torch.from_numpy(tensor[0])
+    residual = model_manager.generate_state(model.residual_shape)
+    memory = model_manager.generate_state(model.memory_shape)
+
+    def forward_step():
+        with torch.no_grad():
+            model.network.forward(step, residual, memory)
+    results['forward_step'] = measure(forward_step, args.repeats)
+
+    def forecast():
+        with torch.no_grad():
+            model.forecast(tensor)
+    results['forecast'] = measure(forecast, args.repeats)
+
+    x, y = model.segment_data(model_manager.convert_to_torch_tensor(tensor))
+    criterion = torch.nn.MSELoss()
+
+    def training_step():
+        model.optimizer.zero_grad()
+        model.backpropagate(model_manager.generate_state(model.residual_shape),
+                            model_manager.generate_state(model.memory_shape), x, y, criterion)
+        model.optimizer.step()
+    results['training_step'] = measure(training_step, args.repeats)
+
+    directory = tempfile.mkdtemp()
+    package_path = os.path.join(directory, 'benchmark_model.zip')
+
+    def save_package():
+        network_utilities.save_model_package(model.network, meta_data, 'file:/' + package_path,
+                                             optimizer_state=model.extract_optimizer_state())
+    results['package_save'] = measure(save_package, args.repeats)
+    results['package_load'] = measure(lambda: network_utilities.load_model_package(package_path), args.repeats)
+    results['package_weights_load'] = measure(lambda: network_utilities.get_package_weights('file:/' + package_path),
+                                              args.repeats)
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads()}
+
+
+# A benchmark has regressed when its fastest time is more than `tolerance` slower than the baseline's, plus the
+# baseline's own noise, how much slower its 90th percentile was than its fastest time. The fastest time is the one
+# least disturbed by the rest of the machine, so it's what's compared, rather than the median.
+# Benchmarks are only compared when they were run with the same configuration.
+def compare(report, baseline, tolerance):
+    if report['config'] != baseline['config']:
+        raise Exception('the baseline was run with a different configuration: {}'.format(str(baseline['config'])))
+    comparison = dict()
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        baseline_result = baseline['results'][name]
+        ratio = result['min'] / baseline_result['min']
+        noise = baseline_result['p90'] / baseline_result['min'] - 1
+        threshold = 1 + tolerance + noise
+        comparison[name] = {'ratio': ratio, 'threshold': threshold, 'regressed': ratio > threshold}
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the training and forecasting hot paths on synthetic data.")
+    parser.add_argument('--sequence_length', type=int, default=1000, help="The number of timesteps in the synthetic series.")
+    parser.add_argument('--io_dimension', type=int, default=8, help="The number of variables in the synthetic series.")
+    parser.add_argument('--forecast_length', type=int, default=10, help="The number of steps to forecast.")
+    parser.add_argument('--model_complexity', type=float, default=0.5, help="The complexity of the benchmarked model.")
+    parser.add_argument('--repeats', type=int, default=20, help="How many times every benchmark is timed, after warming up.")
+    parser.add_argument('--seed', type=int, default=0, help="Seeds the synthetic data and the model's weights.")
+    parser.add_argument('--threads', type=int, default=1, help="The number of threads torch uses within an operation.")
+    parser.add_argument('--output_path', type=str, help="Where to write the json results, printed if not set.")
+    parser.add_argument('--baseline_path', type=str, help="A previous run's json results to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="How much slower than the baseline a benchmark can be, on top of the baseline's noise, "
+                             "before it counts as a regression.")
+    args = parser.parse_args()
+    config = {'sequence_length': args.sequence_length, 'io_dimension': args.io_dimension,
+              'forecast_length': args.forecast_length, 'model_complexity': args.model_complexity,
+              'repeats': args.repeats, 'seed': args.seed, 'threads': args.threads}
+    report = {'config': config, 'environment': environment(), 'results': run_benchmarks(args)}
+    regressed = False
+    if args.baseline_path:
+        with open(args.baseline_path) as f:
+            baseline = json.load(f)
+        report['comparison'] = compare(report, baseline, args.tolerance)
+        regressed = any(result['regressed'] for result in report['comparison'].values())
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if regressed:
+        sys.exit(1)
@@ -1,9 +1,13 @@
 import csv
+import os
+import sys
 import numpy as np
 import pandas as pd
-import json
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from serialization import serialize_to_file
+
 
 def format_for_algorithm(data, length, max_vars):
     r"""
@@ -25,7 +29,6 @@ def format_for_algorithm(data, length, max_vars):
         raise Exception('the requested sequence length is too long for your data, please select a smaller number.')
     else:
         out_tensor = np.stack(out_tensor, axis=1)
-    out_tensor = out_tensor.tolist()
     output = {'tensor': out_tensor}
     return output
 
@@ -47,10 +50,6 @@ def trim_to_first_nan(variable):
         output = variable
     return output
 
-def serialize_to_file(path, object):
-    with open(path, 'w') as f:
-        json.dump(object, f)
-
 def load_data_file(file_path):
     data = []
     with open(file_path) as f:
@@ -64,7 +63,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="The m4 dataset formatter.")
     parser.add_argument('--input_path', type=str, help="The local system path to the m4 training dataset (in csv form), can be any type.")
     parser.add_argument('--output_path', type=str,
-                        help="The local system path to where the formatted dataset should live.")
+                        help="The local system path to where the formatted dataset should live, ending in .json, .npy or .npz.")
     parser.add_argument('--num_of_variables', type=int, help="The maximum number of variables we wish to track.")
     parser.add_argument('--sequence_length', type=int, help="The desired sequence length, shorter squences will be filtered out.")
     args = parser.parse_args()
@@ -1,10 +1,14 @@
 import csv
 import datetime
+import os
+import sys
 import time
 import numpy as np
-import json
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from serialization import serialize_to_file
+
 def get_data_for_store(data, store_num):
     r"""
     This function returns the csv data for a single store, filtering out all other stores:
@@ -96,20 +100,14 @@ def format_for_algorithm(file_path, num_stores):
             store_tensors.append(store_tensor)
             stored_stores += 1
     store_tensors = np.concatenate(store_tensors, axis=1)
-    serializable_tensor = store_tensors.tolist()
-    output = {'tensor': serializable_tensor, 'key_variables': key_variables}
+    output = {'tensor': store_tensors, 'key_variables': key_variables}
     return output
 
 
-def serialize_to_file(path, object):
-    with open(path, 'w') as f:
-        json.dump(object, f)
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="The rossman sales data formatter.")
     parser.add_argument('--input_path', type=str, help="The local system path to the rossman training data.")
-    parser.add_argument('--output_path', type=str, help="The local system path to where the formatted data should live.")
+    parser.add_argument('--output_path', type=str, help="The local system path to where the formatted data should live, ending in .json, .npy or .npz.")
     parser.add_argument('--num_of_stores', type=int, help="The number of stores to consolidate into the dataset.")
     args = parser.parse_args()
     result = format_for_algorithm(args.input_path, args.num_of_stores)
@@ -0,0 +1,30 @@
+import json
+import numpy as np
+
+
+def serialize_to_file(path, object):
+    r"""
+    Writes a dataset in the standard timeseries format to `path`, for every formatting tool.
+    The output format is chosen by the file extension of `path`:
+    * `.npy` - the tensor is saved as a float32 numpy array, with the key variables (if any) stored
+    in a json sidecar file, where `data.npy` has a sidecar called `data.meta.json`.
+    * `.npz` - the tensor and key variables are saved together in a numpy archive.
+    * anything else - the standard timeseries format json object.
+    """
+    tensor = np.asarray(object['tensor'], dtype=np.float32)
+    key_variables = object.get('key_variables')
+    if path.endswith('.npy'):
+        np.save(path, tensor)
+        if key_variables:
+            with open(path[:-len('.npy')] + '.meta.json', 'w') as f:
+                json.dump({'key_variables': key_variables}, f)
+    elif path.endswith('.npz'):
+        if key_variables:
+            np.savez(path, tensor=tensor, key_variables=json.dumps(key_variables))
+        else:
+            np.savez(path, tensor=tensor)
+    else:
+        serializable = dict(object)
+        serializable['tensor'] = object['tensor'].tolist()
+        with open(path, 'w') as f:
+            json.dump(serializable, f)